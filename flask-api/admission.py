@@ -0,0 +1,162 @@
+from fnmatch import fnmatchcase
+from math import ceil
+from threading import Condition, Lock
+from time import monotonic
+from typing import Dict, Optional, Tuple
+
+from flask import Flask, g, request, Response
+
+from config import app
+from query_recorder import query_recorder
+
+# The mean time a request holds its slot is smoothed with this weight.
+SMOOTHING = 0.1
+
+
+class Limiter:
+    """
+    This class admits a fixed number of concurrent requests, queues
+    a bounded number of others for at most the timeout, and rejects
+    the rest with an estimate of when a slot will be free
+    """
+    def __init__(self, concurrency: int, queue: int, timeout: float):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.condition = Condition()
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.total_wait = 0.0
+        self.mean_seconds = None
+
+    def acquire(self) -> Optional[int]:
+        # This returns None once the request holds a slot,
+        # and otherwise the status code to reject it with.
+        started_at = monotonic()
+        with self.condition:
+            if self.active >= self.concurrency:
+                if self.waiting >= self.queue:
+                    self.rejected_queue_full += 1
+                    return 429
+                self.waiting += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+                admitted = self.condition.wait_for(
+                    lambda: self.active < self.concurrency, self.timeout)
+                self.waiting -= 1
+                if not admitted:
+                    self.rejected_timeout += 1
+                    return 503
+            self.active += 1
+            self.admitted += 1
+            self.total_wait += monotonic() - started_at
+        return None
+
+    def release(self, seconds: float) -> None:
+        with self.condition:
+            self.active -= 1
+            self.mean_seconds = seconds if self.mean_seconds is None \
+                else self.mean_seconds \
+                + SMOOTHING * (seconds - self.mean_seconds)
+            self.condition.notify()
+        return None
+
+    def get_retry_after(self) -> int:
+        # The queue ahead is drained by every slot in parallel.
+        with self.condition:
+            seconds = (self.mean_seconds or 0.0) * (self.waiting + 1) \
+                / self.concurrency
+        return max(1, ceil(seconds))
+
+    def stats(self) -> Dict:
+        with self.condition:
+            return {
+                'concurrency': self.concurrency,
+                'queue': self.queue,
+                'timeout_seconds': self.timeout,
+                'active': self.active,
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_timeout': self.rejected_timeout,
+                'mean_wait_seconds': self.total_wait / self.admitted
+                if self.admitted else 0.0,
+                'mean_seconds': self.mean_seconds
+                }
+
+
+class AdmissionController:
+    """
+    This class limits the concurrent requests of the connexion
+    operationIds that match each configured pattern, so that slow
+    operations cannot hold every thread and database connection
+    """
+    def __init__(self, limits: Dict[str, Dict]):
+        # The operations matching a pattern share its limiter,
+        # and an operation is limited by the first match only.
+        self.limiters = {pattern: Limiter(**limit)
+                         for pattern, limit in limits.items()}
+        self.lock = Lock()
+        self.operations = {}
+
+    def init_app(self, flask_app: Flask) -> None:
+        flask_app.before_request(self.admit)
+        flask_app.teardown_request(self.release)
+        return None
+
+    def get_limiter(
+            self, operation_id: str) -> Optional[Tuple[str, Limiter]]:
+        with self.lock:
+            if operation_id not in self.operations:
+                self.operations[operation_id] = next(
+                    ((pattern, limiter)
+                     for pattern, limiter in self.limiters.items()
+                     if fnmatchcase(operation_id, pattern)),
+                    None)
+            return self.operations[operation_id]
+
+    def admit(self) -> Optional[Response]:
+        # Unrouted paths are left to answer 404 without a limit.
+        if request.endpoint is None:
+            return None
+        match = self.get_limiter(query_recorder.get_operation_id())
+        if match is None:
+            return None
+        _, limiter = match
+        status = limiter.acquire()
+        if status is not None:
+            response = Response(
+                'Too many concurrent requests for this operation.'
+                if status == 429 else
+                'The server is busy. Please try again later.',
+                status=status)
+            response.headers['Retry-After'] = str(limiter.get_retry_after())
+            return response
+        g.admission = (limiter, monotonic())
+        return None
+
+    @staticmethod
+    def release(exception: Optional[BaseException]) -> None:
+        admission = g.pop('admission', None)
+        if admission is not None:
+            limiter, admitted_at = admission
+            limiter.release(monotonic() - admitted_at)
+        return None
+
+    def stats(self) -> Dict:
+        with self.lock:
+            operations = dict(self.operations)
+        stats = {}
+        for pattern, limiter in self.limiters.items():
+            stats[pattern] = limiter.stats()
+            stats[pattern]['operations'] = sorted(
+                operation_id for operation_id, match in operations.items()
+                if match is not None and match[0] == pattern)
+        return stats
+
+
+admission_controller = AdmissionController(app.config['ADMISSION_LIMITS'])
@@ -0,0 +1,340 @@
+from array import array
+from bisect import bisect_left
+from heapq import nsmallest
+from itertools import islice
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from flask import jsonify, request, Response, url_for
+
+import model
+from config import app, db
+
+CHUNK_SIZE = 10000
+MAX_LIMIT = 50
+# The best matches of every prefix up to this length are
+# kept, because such prefixes match too many names to scan.
+TOP_PREFIX_LENGTH = 2
+MAX_SCAN = 5000
+# Preferred names rank ahead of every synonym.
+PREFERRED_NAME_RANK = -1
+# These attributes are replaced together by a full refresh.
+STATE = (
+    'entries', 'keys', 'keys_sorted', 'trigrams', 'top',
+    'synonym_entries', 'substance_entries', 'preferred_names',
+    'last_synonym_id', 'last_substance_id'
+    )
+
+
+def normalize(name: str) -> str:
+    return ' '.join(name.casefold().split())
+
+
+def get_trigrams(name: str) -> Set[str]:
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+class AutocompleteIndex:
+    """
+    This class holds an in-memory index of the synonyms and preferred
+    names of the generic substances, with a sorted list for prefix
+    matches and trigram postings for matches inside a name
+    """
+    def __init__(self, max_age: float, update_interval: float):
+        self.max_age = max_age
+        self.update_interval = update_interval
+        self.lock = Lock()
+        self.refresh_lock = Lock()
+        self.loaded_at = None
+        self.updated_at = None
+        self.load_seconds = None
+        self.dirty_synonyms = set()
+        self.dirty_substances = set()
+        self.clear()
+
+    def clear(self) -> None:
+        # Each entry is (name, identifier, substance id, rank)
+        # and a removed entry is replaced with None.
+        self.entries = []
+        self.keys = []
+        self.keys_sorted = True
+        self.trigrams = {}
+        self.top = {}
+        self.synonym_entries = {}
+        self.substance_entries = {}
+        self.preferred_names = {}
+        self.last_synonym_id = 0
+        self.last_substance_id = 0
+        return None
+
+    def add(self, identifier: Optional[str], substance_id: int,
+            rank: Optional[int]) -> Optional[int]:
+        # This must be called while holding the lock.
+        name = normalize(identifier or '')
+        if not name or substance_id is None:
+            return None
+        position = len(self.entries)
+        entry = (name, identifier, substance_id,
+                 rank if rank is not None else 0)
+        self.entries.append(entry)
+        # The keys are sorted once after a batch of additions.
+        self.keys.append((name, position))
+        self.keys_sorted = False
+        for trigram in get_trigrams(name):
+            self.trigrams.setdefault(trigram, array('I')).append(position)
+        for length in range(1, TOP_PREFIX_LENGTH + 1):
+            if len(name) >= length:
+                top = self.top.setdefault(name[:length], [])
+                top.append(position)
+                if len(top) > 2 * MAX_LIMIT:
+                    self.trim(top)
+        return position
+
+    def trim(self, top: List[int]) -> None:
+        top[:] = nsmallest(
+            MAX_LIMIT, (position for position in top
+                        if self.entries[position]),
+            key=lambda position: self.get_order(self.entries[position]))
+        return None
+
+    @staticmethod
+    def get_order(entry: Tuple) -> Tuple:
+        name, _, _, rank = entry
+        return rank, len(name), name
+
+    def sort_keys(self) -> None:
+        if not self.keys_sorted:
+            self.keys.sort()
+            self.keys_sorted = True
+        return None
+
+    def remove(self, position: Optional[int]) -> None:
+        # This must be called while holding the lock.
+        if position is not None:
+            self.entries[position] = None
+        return None
+
+    def refresh(self) -> None:
+        with self.refresh_lock:
+            self.rebuild()
+        return None
+
+    def rebuild(self) -> None:
+        # This must be called while holding the refresh lock. The new
+        # index is built aside, so searches keep using the current
+        # one until it is swapped in.
+        started_at = monotonic()
+        with self.lock:
+            self.dirty_synonyms.clear()
+            self.dirty_substances.clear()
+        index = AutocompleteIndex(self.max_age, self.update_interval)
+        index.add_substances(index.get_substances())
+        index.add_synonyms(index.get_synonyms())
+        index.sort_keys()
+        for top in index.top.values():
+            index.trim(top)
+        with self.lock:
+            for name in STATE:
+                setattr(self, name, getattr(index, name))
+            self.loaded_at = self.updated_at = monotonic()
+            self.load_seconds = self.loaded_at - started_at
+        return None
+
+    @staticmethod
+    def get_substances(*criteria) -> Iterable[Tuple[int, str]]:
+        return db.session.query(
+                model.GenericSubstances.id,
+                model.GenericSubstances.preferred_name
+                )\
+            .filter(*criteria)\
+            .execution_options(stream_results=True)\
+            .yield_per(CHUNK_SIZE)
+
+    def add_substances(self, rows: Iterable[Tuple[int, str]]) -> None:
+        for substance_id, preferred_name in rows:
+            self.remove(self.substance_entries.pop(substance_id, None))
+            self.preferred_names[substance_id] = preferred_name
+            self.substance_entries[substance_id] = self.add(
+                preferred_name, substance_id, PREFERRED_NAME_RANK)
+            self.last_substance_id = max(self.last_substance_id, substance_id)
+        return None
+
+    @staticmethod
+    def get_synonyms(*criteria) -> Iterable[Tuple[int, str, int, int]]:
+        return db.session.query(
+                model.SynonymMv.id,
+                model.SynonymMv.identifier,
+                model.SynonymMv.fk_generic_substance_id,
+                model.SynonymMv.rank
+                )\
+            .filter(*criteria)\
+            .execution_options(stream_results=True)\
+            .yield_per(CHUNK_SIZE)
+
+    def add_synonyms(self, rows: Iterable[Tuple[int, str, int, int]]) -> None:
+        for synonym_id, identifier, substance_id, rank in rows:
+            self.remove(self.synonym_entries.pop(synonym_id, None))
+            self.synonym_entries[synonym_id] = self.add(
+                identifier, substance_id, rank)
+            self.last_synonym_id = max(self.last_synonym_id, synonym_id)
+        return None
+
+    def update(self) -> None:
+        # This must be called while holding the refresh lock. It loads
+        # the rows added since the last load and reloads the rows
+        # written through the API, and only holds the lock of the
+        # index to apply them, so searches are not held up by the
+        # queries.
+        with self.lock:
+            synonym_ids, self.dirty_synonyms = self.dirty_synonyms, set()
+            substance_ids, self.dirty_substances = \
+                self.dirty_substances, set()
+            last_synonym_id = self.last_synonym_id
+            last_substance_id = self.last_substance_id
+        substances = list(self.get_substances(
+            (model.GenericSubstances.id > last_substance_id)
+            | model.GenericSubstances.id.in_(substance_ids)
+            ))
+        synonyms = list(self.get_synonyms(
+            (model.SynonymMv.id > last_synonym_id)
+            | model.SynonymMv.id.in_(synonym_ids)
+            ))
+        with self.lock:
+            for synonym_id in synonym_ids:
+                self.remove(self.synonym_entries.pop(synonym_id, None))
+            for substance_id in substance_ids:
+                self.remove(self.substance_entries.pop(substance_id, None))
+                self.preferred_names.pop(substance_id, None)
+            self.add_substances(substances)
+            self.add_synonyms(synonyms)
+            self.sort_keys()
+            self.updated_at = monotonic()
+        return None
+
+    def mark_dirty(self, mapper, connection, target: db.Model) -> None:
+        # The rows are reloaded on the next search, by which
+        # time the write has been committed or rolled back.
+        with self.lock:
+            if isinstance(target, model.SynonymMv):
+                self.dirty_synonyms.add(target.id)
+            else:
+                self.dirty_substances.add(target.id)
+        return None
+
+    def listen(self) -> None:
+        for entity in (model.GenericSubstances, model.SynonymMv):
+            for event_name in ('after_insert', 'after_update',
+                               'after_delete'):
+                db.event.listen(entity, event_name, self.mark_dirty)
+        return None
+
+    def get_index(self) -> None:
+        now = monotonic()
+        with self.lock:
+            loaded_at, updated_at = self.loaded_at, self.updated_at
+            dirty = bool(self.dirty_synonyms or self.dirty_substances)
+        if loaded_at is None or now - loaded_at > self.max_age:
+            action = self.rebuild
+        elif dirty or now - updated_at > self.update_interval:
+            action = self.update
+        else:
+            return None
+        # One request rebuilds or updates the index while the others
+        # search the current one, and only wait for the first load.
+        if self.refresh_lock.acquire(blocking=loaded_at is None):
+            try:
+                if (self.loaded_at, self.updated_at) \
+                        == (loaded_at, updated_at):
+                    action()
+            finally:
+                self.refresh_lock.release()
+        return None
+
+    def get_prefix_matches(self, query: str) -> Iterable[int]:
+        # This must be called while holding the lock.
+        if len(query) <= TOP_PREFIX_LENGTH:
+            return self.top.get(query, [])
+        self.sort_keys()
+        start = bisect_left(self.keys, (query,))
+        positions = []
+        for name, position in islice(self.keys, start, start + MAX_SCAN):
+            if not name.startswith(query):
+                break
+            positions.append(position)
+        return positions
+
+    def get_infix_matches(self, query: str) -> Iterable[int]:
+        # This must be called while holding the lock. The shortest
+        # posting list is scanned and checked for the whole query.
+        trigrams = get_trigrams(query)
+        if not trigrams:
+            return []
+        postings = [self.trigrams.get(trigram, ()) for trigram in trigrams]
+        shortest = min(postings, key=len)
+        return [position for position in islice(shortest, MAX_SCAN)
+                if self.entries[position]
+                and query in self.entries[position][0]]
+
+    def search(self, text: str, limit: int) -> List[Dict]:
+        self.get_index()
+        query = normalize(text)
+        results = {}
+        with self.lock:
+            for get_matches in (self.get_prefix_matches,
+                                self.get_infix_matches):
+                entries = [self.entries[position]
+                           for position in get_matches(query)
+                           if self.entries[position]]
+                for entry in sorted(entries, key=lambda entry: (
+                        entry[0] != query, *self.get_order(entry))):
+                    name, identifier, substance_id, _ = entry
+                    if substance_id not in results:
+                        results[substance_id] = {
+                            'generic_substance_id': substance_id,
+                            'preferred_name':
+                                self.preferred_names.get(substance_id),
+                            'match': identifier
+                            }
+                    if len(results) == limit:
+                        return list(results.values())
+        return list(results.values())
+
+    def stats(self) -> Dict:
+        with self.lock:
+            now = monotonic()
+            return {
+                'entries': sum(1 for entry in self.entries if entry),
+                'trigrams': len(self.trigrams),
+                'age_seconds': now - self.loaded_at
+                if self.loaded_at is not None else None,
+                'update_age_seconds': now - self.updated_at
+                if self.updated_at is not None else None,
+                'load_seconds': self.load_seconds,
+                'max_age_seconds': self.max_age
+                }
+
+
+autocomplete_index = AutocompleteIndex(
+    app.config['AUTOCOMPLETE_INDEX_MAX_AGE'],
+    app.config['AUTOCOMPLETE_UPDATE_INTERVAL']
+    )
+autocomplete_index.listen()
+
+
+def search() -> Response:
+    text = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        limit = 0
+    if not text.strip() or limit < 1 or limit > MAX_LIMIT:
+        response = Response('The URL parameter(s) are incorrect '
+                            'or not specified.', status=400)
+        return response
+    results = autocomplete_index.search(text, limit)
+    for result in results:
+        result['uri'] = url_for(
+            '/api.operations_generic_substances_get_record',
+            primary_key=result['generic_substance_id'], _external=True)
+    return jsonify(results)
@@ -0,0 +1,453 @@
+import argparse
+import json
+import logging
+import sqlite3
+from datetime import datetime, timezone
+from hashlib import md5
+from os import path, remove
+from platform import python_version
+from random import Random
+from statistics import mean, median
+from subprocess import CalledProcessError, check_output
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from config import app, db
+# This registers the API on the application.
+import main  # noqa: F401
+import model
+from new_record_post import get_record_data
+from response_cache import response_cache
+from transformation_mv import rebuild_transformation_mv
+
+PATH = ''
+CHUNK_SIZE = 10000
+# The records of each table per unit of scale.
+SUBSTANCES_PER_CITATION = 10
+SUBSTANCES_PER_AUTHOR = 5
+RELATIONSHIPS_PER_SUBSTANCE = 2
+AUTHORS_PER_CITATION = 3
+FIRST_NAMES = ('Ana', 'Ben', 'Chen', 'Dara', 'Eli', 'Femi', 'Greta', 'Hiro')
+LAST_NAMES = ('Alvarez', 'Brown', 'Cohen', 'Diallo', 'Eriksen', 'Fischer',
+              'Gupta', 'Haddad', 'Ito', 'Jensen', 'Kowalski', 'Li')
+HALF_LIFE_UNITS = ('s', 'min', 'h', 'd')
+PDF = b'%PDF-1.4 synthetic citation'
+# A patch changes this field of each entity to a new value.
+PATCH_FIELDS = {
+    'kinetics': 'half_life',
+    'substance_relationships': 'relationship',
+    'generic_substances': 'preferred_name',
+    'compounds': 'dsstox_compound_id',
+    'author': 'last_name',
+    'citation': 'title'
+    }
+
+# Each case is (operationId, method, path, query string, payload),
+# where a payload of None sends no body.
+Case = Tuple[str, str, str, str, Optional[Dict]]
+
+
+class SyntheticData:
+    """
+    This class fills the schema of model.py with reproducible
+    synthetic records whose counts grow with the scale
+    """
+    def __init__(self, scale: int, seed: int):
+        self.scale = scale
+        self.random = Random(seed)
+        self.substances = scale
+        self.citations = max(1, scale // SUBSTANCES_PER_CITATION)
+        self.authors = max(1, scale // SUBSTANCES_PER_AUTHOR)
+        self.relationships = []
+
+    def insert(self, table: db.Table, rows: Iterator[Dict]) -> None:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == CHUNK_SIZE:
+                db.session.execute(table.insert(), chunk)
+                chunk = []
+        if chunk:
+            db.session.execute(table.insert(), chunk)
+        return None
+
+    def insert_records(self, entity: db.Model,
+                       records: Iterator[Dict]) -> None:
+        # The records get the content hash that the API uses
+        # to find duplicates, as the core inserts skip the ORM.
+        self.insert(entity.__table__, (
+            dict(get_record_data(entity, record), id=record['id'])
+            for record in records))
+        return None
+
+    def get_kinetics(self, relationship_id: Optional[int]) -> Dict:
+        pH = round(self.random.uniform(4.0, 10.0), 1)
+        half_life = round(self.random.lognormvariate(2.0, 1.5), 3)
+        return {
+            'fk_substance_relationship_id': relationship_id,
+            'pH': pH, 'pH_min': pH - 0.5, 'pH_max': pH + 0.5,
+            'half_life': half_life,
+            'half_life_min': round(half_life * 0.8, 3),
+            'half_life_max': round(half_life * 1.2, 3),
+            'half_life_units': self.random.choice(HALF_LIFE_UNITS),
+            'temp_C': float(self.random.choice((20, 25, 30))),
+            'reaction': self.random.choice(('hydrolysis', 'photolysis'))
+            }
+
+    def get_citation(self, number: int) -> Dict:
+        return {
+            'title': 'Synthetic transformation study {}'.format(number),
+            'year': 1980 + number % 45,
+            'month': number % 12 + 1,
+            'journal': 'Journal of Synthetic Chemistry',
+            'volume': number % 60 + 1,
+            'pages': '{}-{}'.format(number, number + 9),
+            'doi': '10.0000/synthetic.{}'.format(number)
+            }
+
+    def generate(self) -> None:
+        self.insert(model.QCLevels.__table__, [
+            {'id': level, 'name': 'level {}'.format(level),
+             'label': 'Level {}'.format(level)}
+            for level in range(1, 6)])
+        self.insert(model.SubstanceRelationshipTypes.__table__, [
+            {'id': 1, 'name': 'transformation_product',
+             'label_forward': 'transforms into',
+             'label_backward': 'is formed from'}])
+        self.insert_records(model.GenericSubstances, (
+            {'id': i, 'fk_qc_level_id': i % 5 + 1,
+             'dsstox_substance_id': 'DTXSID{:07d}'.format(i),
+             'casrn': '{}-{:02d}-{}'.format(1000 + i, i % 100, i % 10),
+             'preferred_name': 'Synthetic substance {}'.format(i),
+             'substance_type': 'Single Compound'}
+            for i in range(1, self.substances + 1)))
+        self.insert_records(model.Compounds, (
+            {'id': i, 'dsstox_compound_id': 'DTXCID{:07d}'.format(i),
+             # Linear alcohols keep every structure parsable.
+             'smiles': 'C' * (i % 30 + 1) + 'O',
+             'mol_weight': 12.011 * (i % 30 + 1) + 17.007}
+            for i in range(1, self.substances + 1)))
+        self.insert(model.generic_substance_compounds, (
+            {'fk_generic_substance_id': i, 'fk_compound_id': i}
+            for i in range(1, self.substances + 1)))
+        self.insert(model.SynonymMv.__table__, (
+            {'fk_generic_substance_id': i, 'identifier': identifier,
+             'synonym_type': synonym_type, 'rank': rank}
+            for i in range(1, self.substances + 1)
+            for identifier, synonym_type, rank in (
+                ('Synthetic substance {}'.format(i), 'preferred name', 1),
+                ('{}-{:02d}-{}'.format(1000 + i, i % 100, i % 10),
+                 'casrn', 2))))
+        pairs = set()
+        while self.substances > 1 and len(pairs) < min(
+                self.substances * RELATIONSHIPS_PER_SUBSTANCE,
+                self.substances * (self.substances - 1) // 2):
+            predecessor, successor = self.random.sample(
+                range(1, self.substances + 1), 2)
+            pairs.add((predecessor, successor))
+        self.relationships = sorted(pairs)
+        self.insert_records(model.SubstanceRelationships, (
+            {'id': i, 'fk_generic_substance_id_predecessor': predecessor,
+             'fk_generic_substance_id_successor': successor,
+             'relationship': 'parent-TP',
+             'fk_substance_relationship_type_id': 1}
+            for i, (predecessor, successor)
+            in enumerate(self.relationships, 1)))
+        self.insert_records(model.Kinetics, (
+            dict(self.get_kinetics(i), id=i)
+            for i in range(1, len(self.relationships) + 1)))
+        self.insert_records(model.Citation, (
+            dict(self.get_citation(i), id=i, pdf=PDF)
+            for i in range(1, self.citations + 1)))
+        self.insert_records(model.Author, (
+            {'id': i, 'first_name': FIRST_NAMES[i % len(FIRST_NAMES)],
+             'middle_name': None,
+             'last_name': '{}-{}'.format(
+                 LAST_NAMES[i % len(LAST_NAMES)], i)}
+            for i in range(1, self.authors + 1)))
+        self.insert(model.author_cited, (
+            {'fk_citation_id': citation_id, 'fk_author_id': author_id}
+            for citation_id in range(1, self.citations + 1)
+            for author_id in self.random.sample(
+                range(1, self.authors + 1),
+                min(AUTHORS_PER_CITATION, self.authors))))
+        self.insert(model.transformation_cited, (
+            {'fk_substance_relationship_id': i, 'fk_kinetics_id': i,
+             'fk_citation_id': self.random.randint(1, self.citations)}
+            for i in range(1, len(self.relationships) + 1)))
+        db.session.commit()
+        rebuild_transformation_mv()
+        return None
+
+    def count(self, name: str) -> int:
+        # This is the number of synthetic records of an entity.
+        return {'kinetics': len(self.relationships),
+                'substance_relationships': len(self.relationships),
+                'author': self.authors,
+                'citation': self.citations}.get(name, self.substances)
+
+    def get_transformation_record(self, number: int) -> Dict:
+        # A new citation makes every posted record a new one.
+        predecessor, successor = self.random.sample(
+            range(1, self.substances + 1), 2)
+        kinetics = self.get_kinetics(None)
+        del kinetics['fk_substance_relationship_id']
+        citation = self.get_citation(self.citations + number)
+        return {
+            'predecessor_dsstox_id': 'DTXSID{:07d}'.format(predecessor),
+            'successor_dsstox_id': 'DTXSID{:07d}'.format(successor),
+            **{key: str(value) for key, value in kinetics.items()},
+            **{key: str(value) for key, value in citation.items()},
+            'authors': '{} {}, {}'.format(
+                self.random.choice(FIRST_NAMES),
+                self.random.choice(LAST_NAMES), 'Benchmark')
+            }
+
+
+def add_functions(connection: sqlite3.Connection, record) -> None:
+    # This adds the MySQL functions that the API calls to SQLite.
+    connection.create_function(
+        'md5', 1,
+        lambda value: md5(value).hexdigest() if value is not None else None,
+        deterministic=True)
+    return None
+
+
+def create_database(database_path: str) -> None:
+    if path.exists(database_path):
+        remove(database_path)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database_path
+    # SQLite opens a file per connection, so no pool is kept.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+    db.event.listen(db.engine, 'connect', add_functions)
+    db.create_all()
+    return None
+
+
+def get_read_cases(data: SyntheticData, repeat: int) -> Iterator[Case]:
+    random = data.random
+    for name in ('kinetics', 'substance_relationships', 'generic_substances',
+                 'compounds', 'author', 'citation'):
+        for _ in range(repeat):
+            yield 'operations.{}.get'.format(name), 'GET', name, \
+                urlencode({'page_size': 100}), None
+            yield 'operations.{}.get_record'.format(name), 'GET', \
+                '{}/{}'.format(name, random.randint(1, data.count(name))), \
+                '', None
+    for _ in range(repeat):
+        substance_id = random.randint(1, data.substances)
+        yield 'operations.generic_substances.get_pathways', 'GET', \
+            'generic_substances/{}/pathways'.format(substance_id), \
+            urlencode({'depth': 3}), None
+        yield 'operations.generic_substances.search', 'GET', \
+            'generic_substances/searchby', \
+            urlencode({'preferred_name':
+                       'Synthetic substance {}'.format(substance_id)}), None
+        yield 'operations.kinetics.search', 'GET', 'kinetics/searchby', \
+            urlencode({'pH[gte]': random.randint(4, 8),
+                       'pH[lte]': random.randint(8, 10),
+                       'page_size': 100}), None
+        yield 'operations.compounds.search', 'GET', 'Compounds/searchby', \
+            urlencode({'smiles[prefix]': 'C' * random.randint(5, 30)}), None
+        yield 'operations.author.search', 'GET', 'author/searchby', \
+            urlencode({'last_name[prefix]': random.choice(LAST_NAMES)}), None
+        yield 'operations.substance_relationships.search', 'GET', \
+            'substance_relationships/searchby', \
+            urlencode({'fk_generic_substance_id_predecessor':
+                       substance_id}), None
+        yield 'operations.citation.search', 'GET', 'citation/searchby', \
+            urlencode({'year': random.randint(1980, 2024)}), None
+        yield 'operations.citation.get_blob', 'GET', \
+            'citation/{}/pdf'.format(random.randint(1, data.citations)), \
+            '', None
+        yield 'operations.transformation_view.search', 'GET', \
+            'transformation_view/searchby', \
+            urlencode({'Predecessor Preferred Name':
+                       'Synthetic substance {}'.format(substance_id)}), None
+    for _ in range(repeat):
+        yield 'operations.transformation_view.get', 'GET', \
+            'transformation_view', urlencode({'page_size': 1000}), None
+        yield 'operations.transformation_view.export', 'GET', \
+            'transformation_view/export', '', None
+    return None
+
+
+def get_payloads(data: SyntheticData, number: int) -> Dict[str, Dict]:
+    random = data.random
+    name = 'Benchmark substance {}'.format(number)
+    return {
+        'kinetics': data.get_kinetics(
+            random.randint(1, len(data.relationships))),
+        'substance_relationships': {
+            'fk_generic_substance_id_predecessor':
+                random.randint(1, data.substances),
+            'fk_generic_substance_id_successor':
+                random.randint(1, data.substances),
+            'relationship': 'benchmark {}'.format(number),
+            'fk_substance_relationship_type_id': 1
+            },
+        'generic_substances': {
+            'fk_qc_level_id': 1,
+            'dsstox_substance_id': 'DTXSIDB{:06d}'.format(number),
+            'preferred_name': name
+            },
+        'compounds': {'smiles': 'C' * (number % 30 + 1) + 'N',
+                      'dsstox_compound_id': 'DTXCIDB{:06d}'.format(number)},
+        'author': {'first_name': 'Benchmark', 'last_name': name},
+        'citation': data.get_citation(data.citations + 10**6 + number)
+        }
+
+
+def run_case(client, case: Case) -> Tuple[float, int, int, bytes]:
+    _, method, route, query_string, payload = case
+    url = '/api/{}{}'.format(route, '?' + query_string if query_string
+                             else '')
+    started_at = perf_counter()
+    response = client.open(
+        url, method=method,
+        json=json.dumps(payload) if payload is not None else None)
+    # A streamed response is only complete once it has been read.
+    body = response.get_data()
+    seconds = perf_counter() - started_at
+    queries = int(response.headers.get('X-DB-Query-Count', 0))
+    return seconds, response.status_code, queries, body
+
+
+def summarize(samples: List[Tuple[float, int, int]]) -> Dict:
+    milliseconds = sorted(seconds * 1000 for seconds, _, _ in samples)
+    return {
+        'requests': len(samples),
+        'errors': sum(status >= 400 for _, status, _ in samples),
+        'statuses': sorted({status for _, status, _ in samples}),
+        'min_ms': round(milliseconds[0], 3),
+        'median_ms': round(median(milliseconds), 3),
+        'p95_ms': round(milliseconds[
+            min(len(milliseconds) - 1, int(0.95 * len(milliseconds)))], 3),
+        'max_ms': round(milliseconds[-1], 3),
+        'mean_ms': round(mean(milliseconds), 3),
+        'mean_queries': round(mean(
+            queries for _, _, queries in samples), 2)
+        }
+
+
+def run_benchmark(data: SyntheticData, repeat: int,
+                  warmup: int) -> Dict[str, Dict]:
+    client = app.test_client()
+    samples = {}
+
+    def record(case: Case) -> Tuple[int, bytes]:
+        seconds, status, queries, body = run_case(client, case)
+        samples.setdefault(case[0], []).append((seconds, status, queries))
+        return status, body
+
+    # The first requests load the lazy indexes and caches.
+    for case in list(get_read_cases(data, warmup)):
+        run_case(client, case)
+    samples.clear()
+    for case in get_read_cases(data, repeat):
+        record(case)
+    created = {}
+    for number in range(repeat):
+        for name, payload in get_payloads(data, number).items():
+            status, body = record(('operations.{}.post'.format(name),
+                                   'POST', name, '', payload))
+            if status == 201:
+                created.setdefault(name, []).append(json.loads(body)['id'])
+        record(('new_record_post.post_new_transformation_record', 'POST',
+                'post_new_transformation_record', '',
+                data.get_transformation_record(number)))
+    for name, primary_keys in created.items():
+        for number, primary_key in enumerate(primary_keys):
+            payload = get_payloads(data, repeat + number)[name]
+            record(('operations.{}.put'.format(name), 'PUT',
+                    '{}/{}'.format(name, primary_key), '', payload))
+            field = PATCH_FIELDS[name]
+            value = get_payloads(data, 2 * repeat + number)[name][field]
+            record(('operations.{}.patch'.format(name), 'PATCH',
+                    '{}/{}'.format(name, primary_key), '', {field: value}))
+    for name, primary_keys in created.items():
+        for primary_key in primary_keys:
+            record(('operations.{}.delete'.format(name), 'DELETE',
+                    '{}/{}'.format(name, primary_key), '', None))
+    return {operation_id: summarize(operation_samples)
+            for operation_id, operation_samples in sorted(samples.items())}
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'],
+                            cwd=path.dirname(path.abspath(__file__)),
+                            text=True).strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+def compare(results: Dict, baseline: Dict) -> List[str]:
+    lines = []
+    for operation_id, stats in results['operations'].items():
+        previous = baseline['operations'].get(operation_id)
+        if not previous or not previous['median_ms']:
+            continue
+        lines.append('{:<56} {:>9.2f} ms {:>+7.1%}'.format(
+            operation_id, stats['median_ms'],
+            stats['median_ms'] / previous['median_ms'] - 1))
+    return lines
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Times every operation of the API against '
+                    'a synthetic SQLite database.')
+    parser.add_argument('--scale', type=int, default=1000,
+                        help='number of generic substances')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='timed requests per operation')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='untimed requests per read operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database',
+                        default=path.join(PATH, 'benchmark.db'))
+    parser.add_argument('--output',
+                        default=path.join(PATH, 'benchmark.json'))
+    parser.add_argument('--baseline',
+                        help='earlier results to compare the medians with')
+    parser.add_argument('--cached', action='store_true',
+                        help='serve repeated reads from the response cache')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    logging.basicConfig(level=logging.WARNING)
+    if not arguments.cached:
+        # Every read reaches the database when nothing is kept.
+        response_cache.ttl = 0
+    with app.app_context():
+        create_database(arguments.database)
+        data = SyntheticData(arguments.scale, arguments.seed)
+        started_at = perf_counter()
+        data.generate()
+        generate_seconds = perf_counter() - started_at
+        operations = run_benchmark(data, arguments.repeat, arguments.warmup)
+    results = {
+        'commit': get_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'scale': arguments.scale,
+        'seed': arguments.seed,
+        'repeat': arguments.repeat,
+        'cached': arguments.cached,
+        'generate_seconds': round(generate_seconds, 3),
+        'operations': operations
+        }
+    with open(arguments.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            print('\n'.join(compare(results, json.load(file))))
+    else:
+        for operation_id, stats in operations.items():
+            print('{:<56} {:>9.2f} ms {:>4} errors'.format(
+                operation_id, stats['median_ms'], stats['errors']))
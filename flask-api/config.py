@@ -1,3 +1,4 @@
+import logging
 from atexit import register
 from os import path, urandom
 from typing import Dict
@@ -5,13 +6,20 @@ from typing import Dict
 import connexion
 from flask import Flask
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
-from sshtunnel import SSHTunnelForwarder
 
+from connection import HOST, TimedQueuePool, TunnelSupervisor
+from replicas import replica_router, RoutingSQLAlchemy
+
+logger = logging.getLogger(__name__)
 
-HOST = '127.0.0.1'
 PATH = ''
+# These are started once by connect_db and reused afterwards. The
+# replica tunnels are keyed by their remote bind address, as are the
+# errors of those that failed to start.
+tunnel_supervisor = None
+replica_tunnel_supervisors = {}
+replica_tunnel_errors = {}
 
 
 def url_encoded(s: str) -> str:
@@ -29,28 +37,64 @@ def url_encoded(s: str) -> str:
     return s
 
 
-def connect_db(application: Flask,
-               database: SQLAlchemy, login_info: Dict) -> None:
-    ssh_tunnel = SSHTunnelForwarder(
-        ssh_address_or_host=login_info['ssh host address'],
-        ssh_username=login_info['ssh username'],
-        ssh_password=login_info['ssh password'],
-        remote_bind_address=(login_info['remote bind address'], 3306)
-        )
-    ssh_tunnel.start()
-    register(ssh_tunnel.stop)
-    application.config['SQLALCHEMY_DATABASE_URI'] = \
-        'mysql://{sql_usr}:{sql_pswd}@{host}:{port}/{database}'\
+def get_database_uri(login_info: Dict, port: int) -> str:
+    return 'mysql://{sql_usr}:{sql_pswd}@{host}:{port}/{database}'\
         .format(
             sql_usr=login_info['sql username'],
             sql_pswd=url_encoded(login_info['sql password']),
             host=HOST,
-            port=ssh_tunnel.local_bind_port,
+            port=port,
             database=login_info['database']
             )
+
+
+def connect_db(application: Flask,
+               database: RoutingSQLAlchemy, login_info: Dict) -> None:
+    global tunnel_supervisor
+    if tunnel_supervisor is None:
+        supervisor = TunnelSupervisor(
+            login_info,
+            # Connections opened through the old tunnel are dead.
+            on_restart=lambda: database.engine.dispose()
+            )
+        # The supervisor is only kept once its tunnel is up,
+        # so that a failed start is tried again on the next call.
+        supervisor.start()
+        register(supervisor.stop)
+        tunnel_supervisor = supervisor
+        application.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri(
+            login_info, tunnel_supervisor.local_port)
+    # Each read replica is reached through a tunnel of its own. A tunnel
+    # that fails to start is left out of the rotation without holding
+    # up the others, and is tried again on the next call.
+    for address in login_info.get('replica bind addresses', []):
+        if address in replica_tunnel_supervisors:
+            continue
+        supervisor = TunnelSupervisor(
+            dict(login_info, **{'remote bind address': address}),
+            on_restart=replica_router.dispose
+            )
+        try:
+            supervisor.start()
+        except Exception as e:
+            logger.warning('The tunnel to read replica %s failed to '
+                           'start: %s', address, e)
+            replica_tunnel_errors[address] = str(e)
+            continue
+        register(supervisor.stop)
+        replica_tunnel_supervisors[address] = supervisor
+        replica_tunnel_errors.pop(address, None)
     # This tests the database connection.
     connection = database.engine.connect()
     connection.close()
+    replica_router.configure(
+        application.config['READ_REPLICA_URIS'] + [
+            get_database_uri(login_info, supervisor.local_port)
+            for supervisor in replica_tunnel_supervisors.values()
+            ],
+        application.config['SQLALCHEMY_ENGINE_OPTIONS'],
+        application.config['READ_REPLICA_STICKY_SECONDS']
+        )
     return None
 
 
@@ -64,8 +108,69 @@ app.secret_key = urandom(16)
 app.config['USERNAME'] = ''
 app.config['JSON_SORT_KEYS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = ''
-app.config['SQLALCHEMY_ECHO'] = True
+app.config['SQLALCHEMY_ECHO'] = False
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': TimedQueuePool,
+    'pool_size': 10,
+    'max_overflow': 10,
+    'pool_timeout': 10,
+    # MySQL closes connections idle for longer than wait_timeout.
+    'pool_recycle': 1800,
+    'pool_pre_ping': True
+    }
+# The list, record and searchby reads go to these replicas in turn,
+# except for this many seconds after the worker committed a write,
+# or after the client made a request that did, as told by a cookie.
+app.config['READ_REPLICA_URIS'] = []
+app.config['READ_REPLICA_STICKY_SECONDS'] = 5.0
+app.config['INCHI_CACHE_SIZE'] = 10000
+# An empty path keeps the InChI cache in memory only.
+app.config['INCHI_CACHE_PATH'] = ''
+app.config['SYNONYM_INDEX_MAX_AGE'] = 3600
+# The autocomplete index is rebuilt after the max age and picks
+# up new and changed rows at most every update interval.
+app.config['AUTOCOMPLETE_INDEX_MAX_AGE'] = 3600
+app.config['AUTOCOMPLETE_UPDATE_INTERVAL'] = 60
+# The pathway graph of a worker is rebuilt after the max age, or when
+# the count or highest id of the relationships, read at most every
+# check interval, shows that another worker has written one.
+app.config['PATHWAY_GRAPH_MAX_AGE'] = 300
+app.config['PATHWAY_GRAPH_CHECK_INTERVAL'] = 5
+# The compound fingerprints are memory mapped from this directory,
+# which python structure_search.py fills before the app is started.
+# The structure searches answer 503 until it has been built.
+app.config['FINGERPRINT_INDEX_PATH'] = path.join(PATH, 'fingerprints')
+# The compounds added since the files were built are indexed at most
+# every check interval, and the files are read again after the max
+# age, to pick up a rebuild with the changed and deleted compounds.
+app.config['FINGERPRINT_INDEX_MAX_AGE'] = 3600
+app.config['FINGERPRINT_INDEX_CHECK_INTERVAL'] = 60
+# The operationIds matching a pattern share its limit of concurrent
+# requests per worker, and up to queue more wait for at most timeout
+# seconds. The limits plus the queues should stay below THREADS, so
+# that the operations without a limit always find a free thread.
+app.config['ADMISSION_LIMITS'] = {
+    'operations.*.export': {'concurrency': 1, 'queue': 0, 'timeout': 0.0},
+    'operations.transformation_view.*':
+        {'concurrency': 1, 'queue': 1, 'timeout': 5.0},
+    'structure_search.substructure':
+        {'concurrency': 1, 'queue': 0, 'timeout': 0.0}
+    }
+# Each worker caches read responses up to these bytes and seconds.
+# A write drops them in every worker forked from the preloaded app.
+app.config['RESPONSE_CACHE_MAX_BYTES'] = 64 * 2**20
+app.config['RESPONSE_CACHE_TTL'] = 300
+# This fraction of requests, and every request that spent at least
+# QUERY_LOG_SLOW_SECONDS in the database, logs its statements.
+app.config['QUERY_LOG_SAMPLE_RATE'] = 0.01
+app.config['QUERY_LOG_SLOW_SECONDS'] = 1.0
+# The validated specification is cached here, keyed by
+# the hash of the YAML file. An empty path disables it.
+app.config['SPEC_CACHE_PATH'] = path.join(
+    PATH, 'openapi', 'swagger.cache.json')
 
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
+replica_router.listen(db.session)
+replica_router.init_app(app)
 ma = Marshmallow(app)
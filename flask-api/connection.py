@@ -0,0 +1,149 @@
+import logging
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Callable, Dict, Optional
+
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+from sshtunnel import SSHTunnelForwarder
+
+logger = logging.getLogger(__name__)
+
+HOST = '127.0.0.1'
+
+
+class PoolStats:
+    """
+    This class accumulates how long requests waited
+    to check a connection out of the engine pool
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float, timed_out: bool) -> None:
+        with self.lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return None
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'total_wait_seconds': self.total_wait,
+                'mean_wait_seconds': self.total_wait / self.checkouts
+                if self.checkouts else 0.0,
+                'max_wait_seconds': self.max_wait
+                }
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    This pool times every checkout, including the
+    time spent waiting for a connection to be returned
+    """
+    def _do_get(self):
+        started_at = monotonic()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_stats.record(monotonic() - started_at, timed_out)
+
+
+class TunnelSupervisor:
+    """
+    This class keeps a single SSH tunnel to the database open, checking
+    it periodically and restarting it on the same local port with
+    exponential backoff whenever it goes down
+    """
+    def __init__(self, login_info: Dict,
+                 check_interval: float = 5.0, max_backoff: float = 60.0,
+                 on_restart: Optional[Callable[[], None]] = None):
+        self.login_info = login_info
+        self.check_interval = check_interval
+        self.max_backoff = max_backoff
+        self.on_restart = on_restart
+        self.tunnel = None
+        self.local_port = 0
+        self.restarts = 0
+        self.last_error = None
+        self.stopped = Event()
+        self.monitor = None
+
+    def open(self) -> None:
+        self.tunnel = SSHTunnelForwarder(
+            ssh_address_or_host=self.login_info['ssh host address'],
+            ssh_username=self.login_info['ssh username'],
+            ssh_password=self.login_info['ssh password'],
+            remote_bind_address=(
+                self.login_info['remote bind address'], 3306),
+            # The local port is kept across restarts so that
+            # the database URI of the engine stays valid.
+            local_bind_address=(HOST, self.local_port),
+            set_keepalive=30.0
+            )
+        self.tunnel.start()
+        self.local_port = self.tunnel.local_bind_port
+        return None
+
+    def start(self) -> None:
+        self.open()
+        self.monitor = Thread(target=self.supervise, daemon=True)
+        self.monitor.start()
+        return None
+
+    def is_up(self) -> bool:
+        if not self.tunnel or not self.tunnel.is_active:
+            return False
+        self.tunnel.check_tunnels()
+        return all(self.tunnel.tunnel_is_up.values())
+
+    def supervise(self) -> None:
+        backoff = self.check_interval
+        while not self.stopped.wait(backoff):
+            try:
+                if self.is_up():
+                    backoff = self.check_interval
+                    continue
+                logger.warning('SSH tunnel is down, restarting it.')
+                self.tunnel.stop()
+                self.open()
+                self.restarts += 1
+                self.last_error = None
+                backoff = self.check_interval
+                if self.on_restart:
+                    self.on_restart()
+            except Exception as e:
+                self.last_error = str(e)
+                backoff = min(backoff * 2, self.max_backoff)
+                logger.warning('SSH tunnel restart failed, retrying in '
+                               '%s seconds: %s', backoff, e)
+        return None
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.tunnel:
+            self.tunnel.stop()
+        return None
+
+    def stats(self) -> Dict:
+        return {
+            'up': bool(self.tunnel and self.tunnel.is_active),
+            'local_port': self.local_port,
+            'restarts': self.restarts,
+            'last_error': self.last_error
+            }
@@ -0,0 +1,96 @@
+import json
+import sys
+from os import path
+from typing import Dict, List
+
+from sqlalchemy import inspect
+
+from config import app, connect_db, db
+from responses import get_content_hash, get_features_except_id
+
+PATH = ''
+CHUNK_SIZE = 1000
+
+
+def set_content_hash(mapper, connection, target: db.Model) -> None:
+    data = {label: getattr(target, label)
+            for label in get_features_except_id(type(target))}
+    target.content_hash = get_content_hash(type(target), data)
+    return None
+
+
+def listen_for_content_hash(entity: db.Model) -> None:
+    db.event.listen(entity, 'before_insert', set_content_hash)
+    db.event.listen(entity, 'before_update', set_content_hash)
+    return None
+
+
+def get_duplicates(entity: db.Model) -> Dict[str, List[int]]:
+    # This maps each content hash shared by several rows to their ids.
+    table = entity.__table__
+    duplicated = db.session.query(table.c.content_hash)\
+        .filter(table.c.content_hash.isnot(None))\
+        .group_by(table.c.content_hash)\
+        .having(db.func.count() > 1)
+    rows = db.session.query(table.c.content_hash, table.c.id)\
+        .filter(table.c.content_hash.in_(duplicated))\
+        .order_by(table.c.content_hash, table.c.id)
+    duplicates = {}
+    for content_hash, row_id in rows:
+        duplicates.setdefault(content_hash, []).append(row_id)
+    return duplicates
+
+
+def backfill_content_hash(entity: db.Model) -> Dict[str, List[int]]:
+    # This adds the column to an existing table, hashes every row
+    # and then enforces uniqueness, unless rows with the same
+    # content already exist, which are returned instead.
+    table = entity.__table__
+    columns = [column['name']
+               for column in inspect(db.engine).get_columns(table.name)]
+    if 'content_hash' not in columns:
+        db.session.execute(db.text(
+            'ALTER TABLE {} ADD COLUMN content_hash CHAR(64)'
+            .format(table.name)))
+    rows = db.session.query(table)\
+        .execution_options(stream_results=True)\
+        .yield_per(CHUNK_SIZE)
+    updates = [{'row_id': row.id,
+                'content_hash': get_content_hash(entity, row._mapping)}
+               for row in rows]
+    if updates:
+        db.session.execute(
+            table.update()
+            .where(table.c.id == db.bindparam('row_id'))
+            .values(content_hash=db.bindparam('content_hash')),
+            updates
+            )
+    db.session.commit()
+    duplicates = get_duplicates(entity)
+    for index in table.indexes:
+        if duplicates and index.unique \
+                and table.c.content_hash in index.columns.values():
+            continue
+        index.create(db.engine, checkfirst=True)
+    return duplicates
+
+
+if __name__ == '__main__':
+    import model
+    with open(path.join(PATH, 'config.json')) as file:
+        login_info = json.load(file)
+    connect_db(app, db, login_info)
+    unique = True
+    for hashed_entity in model.HASHED_ENTITIES:
+        duplicates = backfill_content_hash(hashed_entity)
+        for row_ids in duplicates.values():
+            print('{} rows {} have the same content.'.format(
+                hashed_entity.__tablename__,
+                ', '.join(str(row_id) for row_id in row_ids)))
+        if duplicates:
+            unique = False
+            print('The unique content_hash index of {} was not created. '
+                  'Merge or delete the duplicate rows and run this again.'
+                  .format(hashed_entity.__tablename__))
+    if not unique:
+        sys.exit(1)
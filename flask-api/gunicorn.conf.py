@@ -0,0 +1,59 @@
+import multiprocessing
+from os import environ
+
+# The master imports the app once and forks the workers.
+# Send SIGHUP to the master to reload the workers gracefully.
+bind = environ.get('BIND', '0.0.0.0:5000')
+workers = int(environ.get('WORKERS', multiprocessing.cpu_count()))
+threads = int(environ.get('THREADS', 4))
+worker_class = 'gthread'
+preload_app = True
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+max_requests = 10000
+max_requests_jitter = 1000
+accesslog = '-'
+# The app logs its warnings next to the access log, and the sampled
+# and slow requests of the query recorder are logged at INFO.
+logconfig_dict = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'root': {'level': 'WARNING', 'handlers': ['console']},
+    'loggers': {
+        'query_recorder': {
+            'level': 'INFO', 'handlers': ['console'], 'propagate': False
+            }
+        },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'generic',
+            'stream': 'ext://sys.stdout'
+            }
+        },
+    'formatters': {
+        'generic': {
+            'format': '%(asctime)s [%(process)d] [%(levelname)s] '
+                      '%(name)s: %(message)s',
+            'datefmt': '[%Y-%m-%d %H:%M:%S %z]'
+            }
+        }
+    }
+
+
+def post_fork(server, worker):
+    # The tunnel and engine pool hold sockets, so each
+    # worker opens its own after it has been forked.
+    from main import connect_if_configured
+    from startup import startup_report
+    startup_report.forked()
+    connect_if_configured()
+    startup_report.ready()
+    server.log.info('Worker startup: %s', startup_report.stats())
+
+
+def when_ready(server):
+    from startup import startup_report
+    startup_report.ready()
+    server.log.info('Master startup: %s', startup_report.stats())
@@ -0,0 +1,90 @@
+import sqlite3
+from collections import OrderedDict
+from os import getpid
+from threading import Lock
+from typing import Callable, Dict, Optional, Tuple
+
+
+class InchiCache:
+    """
+    This class memoizes the conversion of SMILES to InChI and InChIKey
+    in a bounded LRU cache, optionally backed by a SQLite file on disk
+    so that conversions survive restarts
+    """
+    def __init__(self, convert: Callable[[str], Tuple[str, str]],
+                 maxsize: int, path: Optional[str] = None):
+        self.convert = convert
+        self.maxsize = maxsize
+        self.path = path
+        self.lock = Lock()
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # The connection is opened on first use in each process, as
+        # one opened before the workers are forked must not be shared.
+        self.connection = None
+        self.connection_pid = None
+
+    def get_disk(self) -> Optional[sqlite3.Connection]:
+        if not self.path:
+            return None
+        if self.connection_pid != getpid():
+            self.connection = sqlite3.connect(
+                self.path, check_same_thread=False
+                )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS inchi ('
+                'smiles TEXT PRIMARY KEY, inchi TEXT, inchi_key TEXT)'
+                )
+            self.connection.commit()
+            self.connection_pid = getpid()
+        return self.connection
+
+    def get(self, smiles: str) -> Tuple[str, str]:
+        with self.lock:
+            if smiles in self.memory:
+                self.memory.move_to_end(smiles)
+                self.hits += 1
+                return self.memory[smiles]
+            disk = self.get_disk()
+            if disk:
+                row = disk.execute(
+                    'SELECT inchi, inchi_key FROM inchi WHERE smiles = ?',
+                    (smiles,)
+                    ).fetchone()
+                if row:
+                    self.disk_hits += 1
+                    self.remember(smiles, tuple(row))
+                    return self.memory[smiles]
+            self.misses += 1
+        # The conversion runs outside of the lock, so a slow
+        # structure does not hold up lookups of other structures.
+        inchi = self.convert(smiles)
+        with self.lock:
+            self.remember(smiles, inchi)
+            disk = self.get_disk()
+            if disk:
+                disk.execute(
+                    'INSERT OR REPLACE INTO inchi VALUES (?, ?, ?)',
+                    (smiles, *inchi)
+                    )
+                disk.commit()
+        return inchi
+
+    def remember(self, smiles: str, inchi: Tuple[str, str]) -> None:
+        self.memory[smiles] = inchi
+        self.memory.move_to_end(smiles)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'size': len(self.memory),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses
+                }
@@ -0,0 +1,240 @@
+import argparse
+import json
+import logging
+from itertools import count
+from os import path
+from random import Random
+from threading import Lock, Thread
+from time import monotonic, perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+from werkzeug.serving import make_server
+
+from benchmark import (
+    Case, create_database, get_commit, get_payloads, get_read_cases,
+    PATCH_FIELDS, SyntheticData
+    )
+from config import app
+from response_cache import response_cache
+
+PATH = ''
+HOST = '127.0.0.1'
+# Each read is drawn from a pool of cases planned this many times over.
+READ_POOL_REPEAT = 50
+DEFAULT_MIX = 'get_record=40,search=25,get=10,view=10,pathways=5,' \
+              'patch=7,post=3'
+PERCENTILES = (50, 95, 99)
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        weights[kind.strip()] = float(weight)
+    return weights
+
+
+def get_kind(operation_id: str) -> str:
+    if operation_id.startswith('operations.transformation_view.'):
+        return 'view'
+    if operation_id.endswith('.get_pathways'):
+        return 'pathways'
+    return operation_id.rsplit('.', 1)[-1]
+
+
+class Workload:
+    """
+    This class draws the requests of the clients from a weighted
+    mix of reads over the synthetic records, patches of those
+    records and posts of new transformation records
+    """
+    def __init__(self, data: SyntheticData, weights: Dict[str, float]):
+        self.data = data
+        self.lock = Lock()
+        self.numbers = count()
+        self.reads = {}
+        for case in get_read_cases(data, READ_POOL_REPEAT):
+            # An export reads the whole view, which is not a request
+            # that many clients would make at the same time.
+            if not case[0].endswith('.export'):
+                self.reads.setdefault(get_kind(case[0]), []).append(case)
+        self.generators = {kind: self.get_read for kind in self.reads}
+        self.generators.update(patch=self.get_patch, post=self.get_post)
+        unknown = set(weights) - set(self.generators)
+        if unknown:
+            raise ValueError('Unknown kinds in the mix: {}'.format(
+                ', '.join(sorted(unknown))))
+        self.kinds = [kind for kind in weights if weights[kind] > 0]
+        self.weights = [weights[kind] for kind in self.kinds]
+
+    def get_read(self, kind: str, random: Random) -> Case:
+        return random.choice(self.reads[kind])
+
+    def get_patch(self, kind: str, random: Random) -> Case:
+        # The synthetic records keep their ids, so any of them can be
+        # patched, and the counter makes every new value unique.
+        with self.lock:
+            payloads = get_payloads(self.data, next(self.numbers))
+        name = random.choice(sorted(PATCH_FIELDS))
+        field = PATCH_FIELDS[name]
+        return 'operations.{}.patch'.format(name), 'PATCH', \
+            '{}/{}'.format(name, random.randint(1, self.data.count(name))), \
+            '', {field: payloads[name][field]}
+
+    def get_post(self, kind: str, random: Random) -> Case:
+        with self.lock:
+            payload = self.data.get_transformation_record(
+                next(self.numbers))
+        return 'new_record_post.post_new_transformation_record', 'POST', \
+            'post_new_transformation_record', '', payload
+
+    def next_case(self, random: Random) -> Case:
+        kind = random.choices(self.kinds, self.weights)[0]
+        return self.generators[kind](kind, random)
+
+
+def run_client(base_url: str, workload: Workload, seed: int,
+               stop_at: float, record: Callable) -> None:
+    random = Random(seed)
+    session = requests.Session()
+    while monotonic() < stop_at:
+        operation_id, method, route, query_string, payload = \
+            workload.next_case(random)
+        url = '{}/api/{}{}'.format(
+            base_url, route, '?' + query_string if query_string else '')
+        started_at = perf_counter()
+        try:
+            response = session.request(
+                method, url,
+                json=json.dumps(payload) if payload is not None else None)
+            status = response.status_code
+        except requests.RequestException:
+            status = None
+        record(operation_id, perf_counter() - started_at, status)
+    session.close()
+    return None
+
+
+def percentile(milliseconds: List[float], rank: float) -> float:
+    # This is the nearest-rank percentile of a sorted list.
+    index = max(0, min(len(milliseconds) - 1,
+                       int(round(rank / 100 * len(milliseconds))) - 1))
+    return round(milliseconds[index], 3)
+
+
+def summarize(samples: List[Tuple[float, Optional[int]]],
+              seconds: float) -> Dict:
+    milliseconds = sorted(latency * 1000 for latency, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(status is None or status >= 400 for _, status in samples)
+    return {
+        'requests': len(samples),
+        'throughput_rps': round(len(samples) / seconds, 2),
+        'error_rate': round(errors / len(samples), 4),
+        'statuses': dict(sorted(statuses.items())),
+        **{'p{}_ms'.format(rank): percentile(milliseconds, rank)
+           for rank in PERCENTILES},
+        'max_ms': round(milliseconds[-1], 3)
+        }
+
+
+def run_load(base_url: str, workload: Workload, clients: int,
+             duration: float, seed: int) -> Dict:
+    lock = Lock()
+    samples = {}
+
+    def record(operation_id: str, latency: float,
+               status: Optional[int]) -> None:
+        with lock:
+            samples.setdefault(operation_id, []).append((latency, status))
+        return None
+
+    started_at = monotonic()
+    threads = [
+        Thread(target=run_client,
+               args=(base_url, workload, seed + client,
+                     started_at + duration, record))
+        for client in range(clients)
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = monotonic() - started_at
+    return {
+        'seconds': round(seconds, 3),
+        'total': summarize(
+            [sample for operation_samples in samples.values()
+             for sample in operation_samples], seconds),
+        'operations': {
+            operation_id: summarize(operation_samples, seconds)
+            for operation_id, operation_samples in sorted(samples.items())
+            }
+        }
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Replays a mix of reads and writes from concurrent '
+                    'clients against the API served over a synthetic '
+                    'SQLite database.')
+    parser.add_argument('--scale', type=int, default=1000,
+                        help='number of generic substances')
+    parser.add_argument('--clients', type=int, default=16,
+                        help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='seconds to run the clients for')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='comma-separated weights of the request '
+                             'kinds: get, get_record, search, view, '
+                             'pathways, get_blob, patch and post')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database',
+                        default=path.join(PATH, 'loadtest.db'))
+    parser.add_argument('--output',
+                        default=path.join(PATH, 'loadtest.json'))
+    parser.add_argument('--no-cache', action='store_true',
+                        help='send every read to the database')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    logging.basicConfig(level=logging.WARNING)
+    # The access log of every request would slow the clients down.
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    if arguments.no_cache:
+        response_cache.ttl = 0
+    with app.app_context():
+        create_database(arguments.database)
+        data = SyntheticData(arguments.scale, arguments.seed)
+        data.generate()
+    workload = Workload(data, parse_mix(arguments.mix))
+    # Each request is handled in a thread of its own, as by the
+    # gthread workers of gunicorn, and gets its own app context.
+    server = make_server(HOST, 0, app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://{}:{}'.format(HOST, server.server_port)
+    results = run_load(base_url, workload, arguments.clients,
+                       arguments.duration, arguments.seed)
+    server.shutdown()
+    results = {
+        'commit': get_commit(),
+        'scale': arguments.scale,
+        'clients': arguments.clients,
+        'mix': parse_mix(arguments.mix),
+        'cached': not arguments.no_cache,
+        **results
+        }
+    with open(arguments.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print('{:<56} {:>8} {:>9} {:>9} {:>9} {:>7}'.format(
+        'operationId', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for operation_id, stats in (*results['operations'].items(),
+                                ('total', results['total'])):
+        print('{:<56} {:>8.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>7.1%}'.format(
+            operation_id, stats['throughput_rps'], stats['p50_ms'],
+            stats['p95_ms'], stats['p99_ms'], stats['error_rate']))
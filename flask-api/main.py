@@ -1,32 +1,161 @@
+# This is imported first so that the report also times the imports.
+from startup import startup_report
 import json
+import logging
 from os import path
 
-from flask import Response
+from flask import jsonify, Response
 
+import config
+from admission import admission_controller
+from autocomplete import autocomplete_index
 from config import connexion_app, app, connect_db, db
+from connection import pool_stats, TimedQueuePool
+from new_record_post import inchi_cache, synonym_index
+from pathway_graph import pathway_graph
+from query_recorder import query_recorder
+from replicas import replica_router
+from response_cache import response_cache
+from search_report import search_report
+from structure_search import fingerprint_index
+from spec_cache import add_cached_api
 
 HOST = '127.0.0.1'
 PORT = 5000
 PATH = ''
 
-connexion_app.add_api('swagger.yaml')
+startup_report.mark('imports')
+with startup_report.timed('add_api'):
+    api, spec_cached = add_cached_api(
+        connexion_app, 'swagger.yaml', app.config['SPEC_CACHE_PATH'])
+startup_report.set_detail('spec_cached', spec_cached)
+query_recorder.init_app(app)
+query_recorder.register_api(api)
+admission_controller.init_app(app)
+
+
+def connect_from_file() -> None:
+    with open(path.join(PATH, 'config.json')) as file:
+        login_info = json.load(file)
+    connect_db(app, db, login_info)
+    return None
+
+
+def connect_if_configured() -> None:
+    if path.exists(path.join(PATH, 'config.json')):
+        with startup_report.timed('connect'):
+            connect_from_file()
+    return None
 
 
 @connexion_app.route('/api/connect/', methods=['GET'])
 def connect() -> Response:
     try:
-        with open(path.join(PATH, 'config.json')) as file:
-            login_info = json.load(file)
-        connect_db(app, db, login_info)
+        connect_from_file()
     except Exception as e:
         return Response(str(e), status=500)
     return Response('Connected to {}'.format(db.engine), status=200)
 
 
+@connexion_app.route('/api/stats/admission/', methods=['GET'])
+def admission_stats() -> Response:
+    return jsonify(admission_controller.stats())
+
+
+@connexion_app.route('/api/autocomplete/refresh/', methods=['POST'])
+def refresh_autocomplete_index() -> Response:
+    autocomplete_index.refresh()
+    return jsonify(autocomplete_index.stats())
+
+
+@connexion_app.route('/api/stats/autocomplete/', methods=['GET'])
+def autocomplete_stats() -> Response:
+    return jsonify(autocomplete_index.stats())
+
+
+@connexion_app.route('/api/stats/db_pool/', methods=['GET'])
+def db_pool_stats() -> Response:
+    stats = pool_stats.stats()
+    if app.config['SQLALCHEMY_DATABASE_URI']:
+        pool = db.engine.pool
+        stats['status'] = pool.status()
+        if isinstance(pool, TimedQueuePool):
+            stats.update(size=pool.size(), checked_out=pool.checkedout(),
+                         overflow=pool.overflow())
+    if config.tunnel_supervisor:
+        stats['tunnel'] = config.tunnel_supervisor.stats()
+    return jsonify(stats)
+
+
+@connexion_app.route('/api/stats/inchi_cache/', methods=['GET'])
+def inchi_cache_stats() -> Response:
+    return jsonify(inchi_cache.stats())
+
+
+@connexion_app.route('/api/stats/pathway_graph/', methods=['GET'])
+def pathway_graph_stats() -> Response:
+    return jsonify(pathway_graph.stats())
+
+
+@connexion_app.route('/api/stats/queries/', methods=['GET'])
+def query_stats() -> Response:
+    return jsonify(query_recorder.stats())
+
+
+@connexion_app.route('/api/stats/replicas/', methods=['GET'])
+def replica_stats() -> Response:
+    stats = replica_router.stats()
+    stats['tunnels'] = {
+        address: supervisor.stats() for address, supervisor
+        in config.replica_tunnel_supervisors.items()
+        }
+    stats['tunnels'].update({
+        address: {'up': False, 'last_error': error}
+        for address, error in config.replica_tunnel_errors.items()
+        })
+    return jsonify(stats)
+
+
+@connexion_app.route('/api/stats/response_cache/', methods=['GET'])
+def response_cache_stats() -> Response:
+    return jsonify(response_cache.stats())
+
+
+@connexion_app.route('/api/stats/synonym_index/', methods=['GET'])
+def synonym_index_stats() -> Response:
+    return jsonify(synonym_index.stats())
+
+
+@connexion_app.route('/api/stats/search/', methods=['GET'])
+def search_stats() -> Response:
+    return jsonify(search_report.report())
+
+
+@connexion_app.route('/api/stats/fingerprint_index/', methods=['GET'])
+def fingerprint_index_stats() -> Response:
+    return jsonify(fingerprint_index.stats())
+
+
+@connexion_app.route('/api/stats/startup/', methods=['GET'])
+def startup_stats() -> Response:
+    return jsonify(startup_report.stats())
+
+
+@connexion_app.route('/api/synonym_index/refresh/', methods=['POST'])
+def refresh_synonym_index() -> Response:
+    synonym_index.refresh()
+    return jsonify(synonym_index.stats())
+
+
 @connexion_app.route('/')
 def home():
     return Response('Connected to home page.', status=200)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('query_recorder').setLevel(logging.INFO)
+    # The tunnel and engine are set up once at boot.
+    connect_if_configured()
+    startup_report.ready()
     connexion_app.run(host=HOST, port=PORT, debug=True)
@@ -1,6 +1,6 @@
-from flask import url_for
-
 from config import db, ma
+from content_hash import listen_for_content_hash
+from serializer import RecordUri
 
 
 class Kinetics(db.Model):
@@ -28,18 +28,16 @@ class Kinetics(db.Model):
     temp_C = db.Column(db.Float)
     activation_kcal_per_mol = db.Column(db.Float)
     comments = db.Column(db.String)
+    content_hash = db.Column(db.String(64), index=True, unique=True)
 
 
 class KineticsSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Kinetics
         load_instance = True
+        exclude = ('content_hash',)
         include_fk = True
-    uri = ma.Function(
-        lambda obj:
-        url_for('/api.operations_kinetics_get_record',
-                primary_key=obj.id, _external=True)
-        )
+    uri = RecordUri('/api.operations_kinetics_get_record')
 
 
 class SubstanceRelationships(db.Model):
@@ -68,6 +66,7 @@ class SubstanceRelationships(db.Model):
     is_nearest_casrn = db.Column(db.Integer)
     created_by = db.Column(db.String)
     updated_by = db.Column(db.String)
+    content_hash = db.Column(db.String(64), index=True, unique=True)
     # unidirectional
     kinetic_data = db.relationship('Kinetics')
 
@@ -76,12 +75,9 @@ class SubstanceRelationshipsSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = SubstanceRelationships
         load_instance = True
+        exclude = ('content_hash',)
         include_fk = True
-    uri = ma.Function(
-        lambda obj:
-        url_for('/api.operations_substance_relationships_get_record',
-                primary_key=obj.id, _external=True)
-        )
+    uri = RecordUri('/api.operations_substance_relationships_get_record')
 
 
 class SubstanceRelationshipTypes(db.Model):
@@ -188,6 +184,7 @@ class Compounds(db.Model):
     updated_by = db.Column(db.String)
     created_at = db.Column(db.String)
     updated_at = db.Column(db.String)
+    content_hash = db.Column(db.String(64), index=True, unique=True)
     # mol_image_png = db.Column(db.LargeBinary)
 
 
@@ -195,11 +192,8 @@ class CompoundsSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Compounds
         load_instance = True
-    uri = ma.Function(
-        lambda obj:
-        url_for('/api.operations_compounds_get_record',
-                primary_key=obj.id, _external=True)
-        )
+        exclude = ('content_hash',)
+    uri = RecordUri('/api.operations_compounds_get_record')
 
 
 class GenericSubstances(db.Model):
@@ -223,10 +217,10 @@ class GenericSubstances(db.Model):
     updated_by = db.Column(db.String)
     created_at = db.Column(db.String)
     updated_at = db.Column(db.String)
+    content_hash = db.Column(db.String(64), index=True, unique=True)
     structure = db.relationship(
         'Compounds',
         secondary=generic_substance_compounds,
-        lazy='subquery',
         backref=db.backref('generic_substances', lazy=True)
         )
     # unidirectional
@@ -256,12 +250,9 @@ class GenericSubstancesSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = GenericSubstances
         load_instance = True
+        exclude = ('content_hash',)
         include_fk = True
-    uri = ma.Function(
-        lambda obj:
-        url_for('/api.operations_generic_substances_get_record',
-                primary_key=obj.id, _external=True)
-        )
+    uri = RecordUri('/api.operations_generic_substances_get_record')
 
 
 class QCLevels(db.Model):
@@ -331,17 +322,15 @@ class Author(db.Model):
     first_name = db.Column(db.String)
     middle_name = db.Column(db.String)
     last_name = db.Column(db.String)
+    content_hash = db.Column(db.String(64), index=True, unique=True)
 
 
 class AuthorSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Author
         load_instance = True
-    uri = ma.Function(
-        lambda obj:
-        url_for('/api.operations_author_get_record',
-                primary_key=obj.id, _external=True)
-        )
+        exclude = ('content_hash',)
+    uri = RecordUri('/api.operations_author_get_record')
 
 
 class Citation(db.Model):
@@ -361,17 +350,17 @@ class Citation(db.Model):
     pages = db.Column(db.String)
     title = db.Column(db.String)
     journal = db.Column(db.String)
-    pdf = db.Column(db.LargeBinary)
+    # deferred so that listing citations does not load the file
+    pdf = db.deferred(db.Column(db.LargeBinary))
+    content_hash = db.Column(db.String(64), index=True, unique=True)
     author = db.relationship(
         'Author',
         secondary=author_cited,
-        lazy='subquery',
         backref=db.backref('citation', lazy=True)
         )
     kinetics = db.relationship(
         'Kinetics',
         secondary=transformation_cited,
-        lazy='subquery',
         backref=db.backref('citation', lazy=True)
         )
 
@@ -380,232 +369,112 @@ class CitationSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Citation
         load_instance = True
-    uri = ma.Function(
-        lambda obj:
-        url_for('/api.operations_citation_get_record',
-                primary_key=obj.id, _external=True)
-        )
-
-
-class TransformationView(db.Model):
+        exclude = ('content_hash',)
+        load_only = ('pdf',)
+    uri = RecordUri('/api.operations_citation_get_record')
+    pdf_uri = RecordUri('/api.operations_citation_get_blob')
+
+
+HASHED_ENTITIES = [
+    Kinetics, SubstanceRelationships, Compounds,
+    GenericSubstances, Author, Citation
+    ]
+for hashed_entity in HASHED_ENTITIES:
+    listen_for_content_hash(hashed_entity)
+
+# These are the relationships that ?include= adds to the records,
+# with the schema that each related record is dumped with.
+INCLUDES = {
+    Kinetics: {'citation': CitationSchema},
+    SubstanceRelationships: {'kinetic_data': KineticsSchema},
+    Compounds: {'generic_substances': GenericSubstancesSchema},
+    GenericSubstances: {
+        'structure': CompoundsSchema,
+        'predecessor_relationship': SubstanceRelationshipsSchema,
+        'successor_relationship': SubstanceRelationshipsSchema,
+        'synonym_mv': SynonymMvSchema
+        },
+    Author: {'citation': CitationSchema},
+    Citation: {'author': AuthorSchema, 'kinetics': KineticsSchema}
+    }
+
+
+class TransformationMv(db.Model):
     """
-    SELECT
-        PRED.dsstox_substance_id AS 'Predecessor DSSTox ID',
-        PRED.preferred_name AS 'Predecessor Preferred Name',
-        PRED.casrn AS 'Predecessor CASRN',
-        PRED.smiles AS 'Predecessor SMILES',
-        PRED.substance_type AS 'Predecessor Type',
-        PRED.label AS 'Predecessor Name:SMILES:CASRN QC Level',
-        SUCC.dsstox_substance_id AS 'Successor DSSTox ID',
-        SUCC.preferred_name AS 'Successor Preferred Name',
-        SUCC.smiles AS 'Successor SMILES',
-        SUCC.casrn AS 'Successor CASRN',
-        SUCC.substance_type AS 'Successor Type',
-        SUCC.label AS 'Successor Name:SMILES:CASRN QC Level',
-        SR.relationship AS 'Relationship',
-        K.pH,
-        K.pH_min AS 'Minimum pH',
-        K.pH_max as 'Maximum pH',
-        K.half_life AS 'Half-life',
-        K.half_life_min AS 'Minimum Half-life',
-        K.half_life_max AS 'Maximum Half-life',
-        K.half_life_units AS 'Half-life Units',
-        K.rate AS 'Rate Constant',
-        K.rate_min AS 'Minimum Rate Constant',
-        K.rate_max AS 'Maximum Rate Constant',
-        K.rate_units AS 'Rate Constant Units',
-        K.activation_kcal_per_mol AS 'Activation Energy (kcal/mol)',
-        K.temp_C AS 'Temperature Centigrade',
-        K.reaction AS 'Reaction',
-        K.comments AS 'Comments',
-        GROUP_CONCAT(
-            CASE
-                WHEN CONCAT_WS(' ', A.first_name, A.middle_name, A.last_name) = ' '
-                THEN NULL
-                ELSE CONCAT_WS(' ', A.first_name, A.middle_name, A.last_name)
-            END
-            ORDER BY A.last_name
-            SEPARATOR ', '
-            ) AS 'Authors',
-        C.year AS 'Year',
-        C.month AS 'Month',
-        C.day AS 'Day',
-        C.publisher AS 'Publisher',
-        C.title AS 'Title',
-        C.journal AS 'Journal',
-        C.volume AS 'Volume',
-        C.issue AS 'Issue',
-        C.pages AS 'Pages',
-        C.doi AS 'DOI',
-        c.url AS 'URL',
-        C.pdf AS 'PDF Blob'
-    FROM
-        substance_relationships SR
-        INNER JOIN substance_relationship_types SRT
-            ON SR.fk_substance_relationship_type_id = SRT.id
-        INNER JOIN ( -- predecessor substance
-            SELECT
-                GSP.id,
-                GSP.dsstox_substance_id,
-                GSP.preferred_name,
-                GSP.casrn,
-                CP.smiles,
-                GSP.substance_type,
-                QCP.label
-            FROM
-                generic_substances GSP
-                INNER JOIN qc_levels QCP
-                    ON GSP.fk_qc_level_id = QCP.id
-                LEFT JOIN generic_substance_compounds GSCP
-                    ON GSCP.fk_generic_substance_id = GSP.id
-                LEFT JOIN compounds CP
-                    ON GSCP.fk_compound_id = CP.id
-            )
-        AS PRED
-            ON SR.fk_generic_substance_id_predecessor = PRED.id
-        LEFT JOIN ( -- successor substance
-            SELECT
-                GSS.id,
-                GSS.dsstox_substance_id,
-                GSS.preferred_name,
-                GSS.casrn,
-                CS.smiles,
-                GSS.substance_type,
-                QCS.label
-            FROM
-                generic_substances GSS
-                INNER JOIN qc_levels QCS
-                    ON GSS.fk_qc_level_id = QCS.id
-                LEFT JOIN generic_substance_compounds GSCS
-                    ON GSCS.fk_generic_substance_id = GSS.id
-                LEFT JOIN compounds CS
-                    ON GSCS.fk_compound_id = CS.id
-            )
-        AS SUCC
-            ON SR.fk_generic_substance_id_successor = SUCC.id
-        LEFT JOIN kinetics K
-            ON K.fk_substance_relationship_id = SR.id
-        INNER JOIN transformation_cited TC
-            ON TC.fk_substance_relationship_id = SR.id
-        INNER JOIN citation C
-            ON TC.fk_citation_id = C.id
-        LEFT JOIN author_cited AC
-            ON AC.fk_citation_id = C.id
-        LEFT JOIN author A
-            ON AC.fk_author_id = A.id
-    WHERE
-        SRT.name = 'transformation_product'
-    GROUP BY
-        PRED.dsstox_substance_id,
-        PRED.preferred_name,
-        PRED.smiles,
-        PRED.casrn,
-        PRED.substance_type,
-        PRED.label,
-        SUCC.dsstox_substance_id,
-        SUCC.preferred_name,
-        SUCC.smiles,
-        SUCC.casrn,
-        SUCC.substance_type,
-        SUCC.label,
-        SR.relationship,
-        K.pH,
-        K.pH_min,
-        K.pH_max,
-        K.half_life,
-        K.half_life_min,
-        K.half_life_max,
-        K.half_life_units,
-        K.rate,
-        K.rate_min,
-        K.rate_max,
-        K.rate_units,
-        K.activation_kcal_per_mol,
-        K.temp_C,
-        K.reaction,
-        K.comments,
-        C.month,
-        C.day,
-        C.year,
-        C.publisher,
-        C.title,
-        C.journal,
-        C.volume,
-        C.issue,
-        C.pages,
-        C.doi,
-        C.url,
-        C.pdf
-    ;
+    Materialized copy of transformation_view with one group of rows per
+    substance relationship, refreshed by transformation_mv.py on writes.
+    The PDF blob is left out and served by /citation/{primary_key}/pdf.
     """
-    __tablename__ = 'transformation_view'
+    __tablename__ = 'transformation_mv'
+    id = db.Column(
+        db.Integer, primary_key=True,
+        autoincrement=True, nullable=False
+        )
+    fk_substance_relationship_id = db.Column(
+        db.Integer, db.ForeignKey('substance_relationships.id'),
+        nullable=False, index=True
+        )
+    fk_citation_id = db.Column(
+        db.Integer, db.ForeignKey('citation.id'),
+        nullable=False, index=True
+        )
     predecessor_dsstox_id = db.Column(
-        'Predecessor DSSTox ID', db.String, primary_key=True)
+        'Predecessor DSSTox ID', db.String(45), index=True)
     predecessor_preferred_name = db.Column(
-        'Predecessor Preferred Name', db.String, primary_key=True)
-    predecessor_smiles = db.Column(
-        'Predecessor SMILES', db.String, primary_key=True)
+        'Predecessor Preferred Name', db.String(255), index=True)
+    predecessor_smiles = db.Column('Predecessor SMILES', db.Text)
     predecessor_casrn = db.Column(
-        'Predecessor CASRN', db.String, primary_key=True)
-    predecessor_type = db.Column(
-        'Predecessor Type', db.String, primary_key=True)
+        'Predecessor CASRN', db.String(45), index=True)
+    predecessor_type = db.Column('Predecessor Type', db.String(255))
     predecessor_qc_level = db.Column(
-        'Predecessor Name:SMILES:CASRN QC Level', db.String, primary_key=True)
+        'Predecessor Name:SMILES:CASRN QC Level', db.String(255))
     successor_dsstox_id = db.Column(
-        'Successor DSSTox ID', db.String, primary_key=True)
+        'Successor DSSTox ID', db.String(45), index=True)
     successor_preferred_name = db.Column(
-        'Successor Preferred Name', db.String, primary_key=True)
-    successor_smiles = db.Column(
-        'Successor SMILES', db.String, primary_key=True)
+        'Successor Preferred Name', db.String(255), index=True)
+    successor_smiles = db.Column('Successor SMILES', db.Text)
     successor_casrn = db.Column(
-        'Successor CASRN', db.String, primary_key=True)
-    successor_type = db.Column(
-        'Successor Type', db.String, primary_key=True)
+        'Successor CASRN', db.String(45), index=True)
+    successor_type = db.Column('Successor Type', db.String(255))
     successor_qc_level = db.Column(
-        'Successor Name:SMILES:CASRN QC Level', db.String, primary_key=True)
-    relationship = db.Column(
-        'Relationship', db.String, primary_key=True)
-    pH = db.Column(db.Float, primary_key=True)
-    pH_min = db.Column('Minimum pH', db.Float, primary_key=True)
-    pH_max = db.Column('Maximum pH', db.Float, primary_key=True)
-    half_life = db.Column('Half-life', db.Float, primary_key=True)
-    half_life_min = db.Column(
-        'Minimum Half-life', db.Float, primary_key=True)
-    half_life_max = db.Column(
-        'Maximum Half-life', db.Float, primary_key=True)
-    half_life_units = db.Column(
-        'Half-life Units', db.String, primary_key=True)
-    rate = db.Column(
-        'Rate Constant', db.Float, primary_key=True)
-    rate_min = db.Column(
-        'Minimum Rate Constant', db.Float, primary_key=True)
-    rate_max = db.Column(
-        'Maximum Rate Constant', db.Float, primary_key=True)
-    rate_units = db.Column(
-        'Rate Constant Units', db.String, primary_key=True)
+        'Successor Name:SMILES:CASRN QC Level', db.String(255))
+    relationship = db.Column('Relationship', db.String(255))
+    pH = db.Column(db.Float)
+    pH_min = db.Column('Minimum pH', db.Float)
+    pH_max = db.Column('Maximum pH', db.Float)
+    half_life = db.Column('Half-life', db.Float)
+    half_life_min = db.Column('Minimum Half-life', db.Float)
+    half_life_max = db.Column('Maximum Half-life', db.Float)
+    half_life_units = db.Column('Half-life Units', db.String(255))
+    rate = db.Column('Rate Constant', db.Float)
+    rate_min = db.Column('Minimum Rate Constant', db.Float)
+    rate_max = db.Column('Maximum Rate Constant', db.Float)
+    rate_units = db.Column('Rate Constant Units', db.String(255))
     activation_kcal_per_mol = db.Column(
-        'Activation Energy (kcal/mol)', db.Float, primary_key=True)
-    temp_C = db.Column(
-        'Temperature Centigrade', db.Float, primary_key=True)
-    reaction = db.Column(
-        'Reaction', db.String, primary_key=True)
-    comments = db.Column('Comments', db.String, primary_key=True)
-    authors = db.Column('Authors', db.String, primary_key=True)
-    year = db.Column('Year', db.Integer, primary_key=True)
-    month = db.Column('Month', db.Integer, primary_key=True)
-    day = db.Column('Day', db.Integer, primary_key=True)
-    publisher = db.Column('Publisher', db.String, primary_key=True)
-    title = db.Column('Title', db.String, primary_key=True)
-    journal = db.Column('Journal', db.String, primary_key=True)
-    volume = db.Column('Volume', db.Integer, primary_key=True)
-    issue = db.Column('Issue', db.String, primary_key=True)
-    pages = db.Column('Pages', db.String, primary_key=True)
-    doi = db.Column('DOI', db.String, primary_key=True)
-    url = db.Column('URL', db.String, primary_key=True)
-    pdf = db.Column('PDF Blob', db.LargeBinary, primary_key=True)
-
-
-class TransformationViewSchema(ma.SQLAlchemyAutoSchema):
+        'Activation Energy (kcal/mol)', db.Float)
+    temp_C = db.Column('Temperature Centigrade', db.Float)
+    reaction = db.Column('Reaction', db.String(255))
+    comments = db.Column('Comments', db.Text)
+    authors = db.Column('Authors', db.Text)
+    year = db.Column('Year', db.Integer, index=True)
+    month = db.Column('Month', db.Integer)
+    day = db.Column('Day', db.Integer)
+    publisher = db.Column('Publisher', db.String(255))
+    title = db.Column('Title', db.Text)
+    journal = db.Column('Journal', db.String(255))
+    volume = db.Column('Volume', db.Integer)
+    issue = db.Column('Issue', db.String(45))
+    pages = db.Column('Pages', db.String(45))
+    doi = db.Column('DOI', db.String(255), index=True)
+    url = db.Column('URL', db.Text)
+
+
+class TransformationMvSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
-        model = TransformationView
+        model = TransformationMv
         load_instance = True
+        exclude = ('id',)
+    pdf_uri = RecordUri(
+        '/api.operations_citation_get_blob',
+        attribute='fk_citation_id'
+        )
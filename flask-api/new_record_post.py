@@ -1,16 +1,79 @@
 import json
 import model
-from typing import Dict, Union
+from threading import local, Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
-from flask import Response, request
-from indigo import Indigo
-from indigo.inchi import IndigoInchi
+from flask import jsonify, Response, request
 
-from responses import get_features_except_id, query_payload
-from config import db
+from responses import (
+    get_content_hash, get_feature_key, get_features_except_id,
+    query_payload
+    )
+from config import app, db
+from inchi_cache import InchiCache
+from pathway_graph import pathway_graph
+from response_cache import response_cache
+from startup import startup_report
+from synonym_index import SynonymIndex
+from transformation_mv import refresh_transformation_mv
 
-indigo = Indigo()
-indigo_inchi = IndigoInchi(indigo)
+# The native libraries are loaded by the first chemistry request,
+# and each thread then creates its own Indigo instances.
+indigo_classes = None
+indigo_lock = Lock()
+indigo_threads = local()
+
+KINETIC_DATA = [
+    'pH', 'pH_min', 'pH_max', 'half_life', 'half_life_min',
+    'half_life_max', 'half_life_units', 'rate', 'rate_min',
+    'rate_max', 'rate_units', 'reaction', 'temp_C',
+    'activation_kcal_per_mol'
+    ]
+WRITTEN_ENTITIES = [
+    model.SubstanceRelationships, model.Kinetics, model.Citation,
+    model.Author, model.TransformationMv
+    ]
+
+
+def load_indigo() -> Tuple[type, type]:
+    global indigo_classes
+    with indigo_lock:
+        if indigo_classes is None:
+            with startup_report.timed('indigo_load'):
+                from indigo import Indigo
+                from indigo.inchi import IndigoInchi
+                indigo_classes = Indigo, IndigoInchi
+    return indigo_classes
+
+
+def get_indigo() -> Tuple:
+    # An Indigo instance must not be shared between threads.
+    if not hasattr(indigo_threads, 'indigo_inchi'):
+        indigo_class, indigo_inchi_class = load_indigo()
+        indigo_threads.indigo = indigo_class()
+        indigo_threads.indigo_inchi = indigo_inchi_class(
+            indigo_threads.indigo)
+    return indigo_threads.indigo, indigo_threads.indigo_inchi
+
+
+def convert_smiles(smiles: str) -> Tuple[str, str]:
+    indigo, indigo_inchi = get_indigo()
+    inchi = indigo_inchi.getInchi(indigo.loadMolecule(smiles))
+    return inchi, indigo_inchi.getInchiKey(inchi)
+
+
+inchi_cache = InchiCache(
+    convert_smiles,
+    app.config['INCHI_CACHE_SIZE'],
+    app.config['INCHI_CACHE_PATH']
+    )
+
+
+synonym_index = SynonymIndex(app.config['SYNONYM_INDEX_MAX_AGE'])
+
+
+def get_inchi_key(smiles: str) -> str:
+    return inchi_cache.get(smiles)[1]
 
 
 def get_substance_relationship_record(
@@ -37,10 +100,10 @@ def get_substance_relationship_record(
     return substance_relationship_record
 
 
-def create_and_post_new_substance_relationship(
+def get_new_substance_relationship_data(
         predecessor_generic_substance_id: int,
         successor_generic_substance_id: int
-        ) -> Union[db.Model, None]:
+        ) -> Dict:
     new_substance_relationship = {
         'fk_generic_substance_id_predecessor':
             predecessor_generic_substance_id,
@@ -57,11 +120,20 @@ def create_and_post_new_substance_relationship(
         'created_by': 'zchiodini',
         'updated_by': 'zchiodini'
         }
+    return new_substance_relationship
+
+
+def create_and_post_new_substance_relationship(
+        predecessor_generic_substance_id: int,
+        successor_generic_substance_id: int
+        ) -> Union[db.Model, None]:
+    new_substance_relationship = get_new_substance_relationship_data(
+        predecessor_generic_substance_id, successor_generic_substance_id)
     schema = model.SubstanceRelationshipsSchema()
     substance_relationship_record = schema.load(
         new_substance_relationship, session=db.session)
     db.session.add(substance_relationship_record)
-    db.session.commit()
+    db.session.flush()
     return substance_relationship_record
 
 
@@ -81,7 +153,7 @@ def create_and_post_new_kinetics_record(
     kinetics_record = schema.load(
         new_kinetics_data, session=db.session)
     db.session.add(kinetics_record)
-    db.session.commit()
+    db.session.flush()
     return kinetics_record
 
 
@@ -103,7 +175,7 @@ def get_citation_record(payload: Dict) -> Union[db.Model, None]:
     new_citation_data = {}
     for label in get_features_except_id(model.Citation).keys():
         value = payload.get(label)
-        new_citation_data.update(label=value)
+        new_citation_data[label] = value
     citation_record = query_payload(
         model.Citation, new_citation_data)
     return citation_record
@@ -119,7 +191,7 @@ def create_and_post_new_citation_record(
     citation_record = schema.load(
         new_citation_data, session=db.session)
     db.session.add(citation_record)
-    db.session.commit()
+    db.session.flush()
     return citation_record
 
 
@@ -167,59 +239,75 @@ def create_and_post_new_transformation_citation_mapping(
         fk_kinetics_id=kinetics_record_id,
         fk_citation_id=citation_record_id
         )
-    db.engine.execute(new_mapping_record)
-    db.session.commit()
+    db.session.execute(new_mapping_record)
     return new_mapping_record
 
 
-def post_and_map_authors(citation_id, payload: Dict) -> None:
-    for author in payload.get('authors').split(','):
-        author = author.strip()
-        if not author:
-            first_name, middle_name, last_name = None, None, None
-        elif author.count(' ') == 1:
-            middle_name = None
-            first_name, last_name = author.split()
-        elif author.count(' ') == 2:
-            first_name, middle_name, last_name = author.split()
-        else:
-            first_name, middle_name = None, None
-            last_name = author
-        author_data = {'first_name': first_name,
-                       'middle_name': middle_name,
-                       'last_name': last_name}
-        author_record = query_payload(model.Author, author_data)
-        if author_record:
-            author_citation_mapping = db.session.query(model.author_cited)\
-                .filter(
-                    model.author_cited.c.fk_author_id == author_record.id,
-                    model.author_cited.c.fk_citation_id == citation_id
-                    )
-            if author_citation_mapping:
-                # record already exists
-                continue
-        else:
-            # insert new author
-            schema = model.AuthorSchema()
-            author_record = schema.load(
-                author_data, session=db.session)
-            db.session.add(author_record)
-            db.session.commit()
-        # insert new author-citation mapping
-        new_mapping_record = model.author_cited.insert().values(
-            fk_citation_id=citation_id, fk_author_id=author_record.id
-            )
-        db.engine.execute(new_mapping_record)
-        db.session.commit()
+def get_author_data(author: str) -> Dict:
+    author = author.strip()
+    if not author:
+        first_name, middle_name, last_name = None, None, None
+    elif author.count(' ') == 1:
+        middle_name = None
+        first_name, last_name = author.split()
+    elif author.count(' ') == 2:
+        first_name, middle_name, last_name = author.split()
+    else:
+        first_name, middle_name = None, None
+        last_name = author
+    author_data = {'first_name': first_name,
+                   'middle_name': middle_name,
+                   'last_name': last_name}
+    return author_data
+
+
+def get_authors_data(payload: Dict) -> Dict[str, Dict]:
+    # The authors are keyed by content hash, so an author
+    # named twice in the same citation is mapped once.
+    authors_data = {}
+    for author in (payload.get('authors') or '').split(','):
+        data = get_record_data(model.Author, get_author_data(author))
+        authors_data.setdefault(data['content_hash'], data)
+    return authors_data
+
+
+def map_authors(citation_authors: Dict[int, Dict[str, Dict]]) -> None:
+    # The authors of every citation are looked up in one query,
+    # the missing ones inserted with executemany, and only the
+    # author-citation mappings not yet in the table are inserted.
+    author_data = {content_hash: data
+                   for authors in citation_authors.values()
+                   for content_hash, data in authors.items()}
+    author_ids = get_ids_by_hash(model.Author, author_data)
+    insert_missing(model.Author.__table__, [
+        data for content_hash, data in author_data.items()
+        if content_hash not in author_ids
+        ])
+    author_ids.update(get_ids_by_hash(
+        model.Author, set(author_data) - set(author_ids)))
+    mapping = model.author_cited.c
+    existing_mappings = set(
+        db.session.query(mapping.fk_citation_id, mapping.fk_author_id)
+            .filter(mapping.fk_citation_id.in_(citation_authors))
+            .all()
+        ) if citation_authors else set()
+    insert_missing(model.author_cited, [
+        {'fk_citation_id': citation_id, 'fk_author_id': author_id}
+        for citation_id, authors in citation_authors.items()
+        for author_id in (author_ids[content_hash]
+                          for content_hash in authors)
+        if (citation_id, author_id) not in existing_mappings
+        ])
+    return None
+
+
+def post_and_map_authors(citation_id: int, payload: Dict) -> None:
+    map_authors({citation_id: get_authors_data(payload)})
     return None
 
 
-def get_generic_substance_id(identifier: str) -> Union[str, None]:
-    substance_id = model.SynonymMv.query\
-        .filter(model.SynonymMv.identifier == identifier)\
-        .order_by(model.SynonymMv.rank)\
-        .first()
-    return substance_id.fk_generic_substance_id
+def get_generic_substance_id(identifier: str) -> Union[int, None]:
+    return synonym_index.get(identifier)
 
 
 def post_new_transformation_record() -> Response:
@@ -250,9 +338,7 @@ def post_new_transformation_record() -> Response:
                 get_generic_substance_record_by_substance_id(
                     substance_id_by_name)
         else:
-            inchi = indigo_inchi.getInchi(
-                indigo.loadMolecule(predecessor_smiles))
-            inchi_key = indigo_inchi.getInchiKey(inchi)
+            inchi_key = get_inchi_key(predecessor_smiles)
             substance_id_by_smiles = get_generic_substance_id(inchi_key)
             if substance_id_by_name != substance_id_by_smiles:
                 response = Response('DSSTox Substance ID(s) not found.',
@@ -287,9 +373,7 @@ def post_new_transformation_record() -> Response:
                     get_generic_substance_record_by_substance_id(
                         substance_id_by_name)
             else:
-                inchi = indigo_inchi.getInchi(
-                    indigo.loadMolecule(successor_smiles))
-                inchi_key = indigo_inchi.getInchiKey(inchi)
+                inchi_key = get_inchi_key(successor_smiles)
                 substance_id_by_smiles = get_generic_substance_id(inchi_key)
                 if substance_id_by_name != substance_id_by_smiles:
                     response = Response('DSSTox Substance ID(s) not found.',
@@ -317,13 +401,7 @@ def post_new_transformation_record() -> Response:
                 predecessor_generic_substance_record.id,
                 successor_generic_substance_record.id
                 )
-    kinetic_data = [
-        'pH', 'pH_min', 'pH_max', 'half_life', 'half_life_min',
-        'half_life_max', 'half_life_units', 'rate', 'rate_min',
-        'rate_max', 'rate_units', 'reaction', 'temp_C',
-        'activation_kcal_per_mol'
-        ]
-    if not any([payload.get(column) for column in kinetic_data]):
+    if not any([payload.get(column) for column in KINETIC_DATA]):
         # Null record
         kinetics_record = model.Kinetics()
     else:
@@ -353,5 +431,245 @@ def post_new_transformation_record() -> Response:
     if record_already_exists:
         response = Response('Record already exists.', status=409)
         return response
+    refresh_transformation_mv([substance_relationship_record.id])
+    # Everything above was only flushed, so the record
+    # is written in a single transaction or not at all.
+    db.session.commit()
+    response_cache.invalidate(*WRITTEN_ENTITIES)
     response = Response('Record successfully posted.', status=200)
     return response
+
+
+def get_record_data(entity: db.Model, data: Dict) -> Dict:
+    # This keeps the columns of the entity coerced to their
+    # types and adds the content hash, which core inserts
+    # do not get from the ORM event listeners.
+    record_data = dict(zip(get_features_except_id(entity),
+                           get_feature_key(entity, data)))
+    record_data['content_hash'] = get_content_hash(entity, record_data)
+    return record_data
+
+
+def get_ids_by_hash(
+        entity: db.Model, content_hashes: Iterable[str]
+        ) -> Dict[str, int]:
+    content_hashes = set(content_hashes)
+    if not content_hashes:
+        return {}
+    rows = db.session.query(entity.content_hash, entity.id)\
+        .filter(entity.content_hash.in_(content_hashes))
+    return dict(rows.all())
+
+
+def get_generic_substance_ids(
+        identifiers: Iterable[str]) -> Dict[str, int]:
+    return synonym_index.get_many(identifiers)
+
+
+def get_generic_substance_ids_by_dsstox_id(
+        dsstox_ids: Iterable[str]) -> Dict[str, int]:
+    dsstox_ids = {dsstox_id for dsstox_id in dsstox_ids if dsstox_id}
+    if not dsstox_ids:
+        return {}
+    rows = db.session.query(
+            model.GenericSubstances.dsstox_substance_id,
+            model.GenericSubstances.id
+            )\
+        .filter(model.GenericSubstances.dsstox_substance_id.in_(dsstox_ids))
+    return dict(rows.all())
+
+
+def get_existing_generic_substance_ids(
+        generic_substance_ids: Iterable[int]) -> Set[int]:
+    generic_substance_ids = set(generic_substance_ids)
+    if not generic_substance_ids:
+        return set()
+    rows = db.session.query(model.GenericSubstances.id)\
+        .filter(model.GenericSubstances.id.in_(generic_substance_ids))
+    return {row.id for row in rows}
+
+
+def get_inchi_keys(smiles: Iterable[str]) -> Dict[str, str]:
+    from indigo import IndigoException
+    inchi_keys = {}
+    for structure in {structure for structure in smiles if structure}:
+        try:
+            inchi_keys[structure] = get_inchi_key(structure)
+        except IndigoException:
+            # An unparsable structure resolves to no substance.
+            continue
+    return inchi_keys
+
+
+def resolve_generic_substance_id(
+        payload: Dict, role: str, lookups: Dict
+        ) -> Tuple[bool, Optional[int]]:
+    dsstox_id = payload.get(role + '_dsstox_id')
+    if dsstox_id:
+        substance_id = lookups['dsstox'].get(dsstox_id)
+        return substance_id is not None, substance_id
+    name = payload.get(role + '_name')
+    if not name:
+        # Only the successor may be left out of a record.
+        return role == 'successor', None
+    substance_id = lookups['synonym'].get(name)
+    smiles = payload.get(role + '_smiles')
+    if smiles:
+        inchi_key = lookups['inchi key'].get(smiles)
+        if lookups['synonym'].get(inchi_key) != substance_id:
+            return False, None
+    return substance_id in lookups['generic substance'], substance_id
+
+
+def get_substance_relationship_ids_by_pair(
+        predecessor_ids: Iterable[int]
+        ) -> Dict[Tuple[int, Optional[int]], int]:
+    relationships = model.SubstanceRelationships
+    rows = db.session.query(
+            relationships.id,
+            relationships.fk_generic_substance_id_predecessor,
+            relationships.fk_generic_substance_id_successor
+            )\
+        .join(model.SubstanceRelationshipTypes,
+              model.SubstanceRelationshipTypes.id
+              == relationships.fk_substance_relationship_type_id)\
+        .filter(
+            model.SubstanceRelationshipTypes.name
+            == 'transformation_product',
+            relationships.fk_generic_substance_id_predecessor
+            .in_(set(predecessor_ids))
+            )
+    return {(predecessor, successor): relationship_id
+            for relationship_id, predecessor, successor in rows}
+
+
+def insert_missing(table: db.Table, rows: List[Dict]) -> None:
+    # A list of parameters is sent to the database with executemany.
+    if rows:
+        db.session.execute(table.insert(), rows)
+    return None
+
+
+def post_new_transformation_records() -> Response:
+    payloads = json.loads(request.get_json())
+    roles = ('predecessor', 'successor')
+    lookups = {
+        'dsstox': get_generic_substance_ids_by_dsstox_id(
+            payload.get(role + '_dsstox_id')
+            for payload in payloads for role in roles),
+        'inchi key': get_inchi_keys(
+            payload.get(role + '_smiles')
+            for payload in payloads for role in roles)
+        }
+    lookups['synonym'] = get_generic_substance_ids(
+        [payload.get(role + '_name')
+         for payload in payloads for role in roles]
+        + list(lookups['inchi key'].values()))
+    lookups['generic substance'] = get_existing_generic_substance_ids(
+        lookups['synonym'].values())
+    statuses = [None] * len(payloads)
+    pairs = {}
+    for index, payload in enumerate(payloads):
+        predecessor_found, predecessor_id = resolve_generic_substance_id(
+            payload, 'predecessor', lookups)
+        successor_found, successor_id = resolve_generic_substance_id(
+            payload, 'successor', lookups)
+        if predecessor_found and successor_found:
+            pairs[index] = (predecessor_id, successor_id)
+        else:
+            statuses[index] = 'not found'
+    created = set()
+    # substance relationships
+    relationship_ids = get_substance_relationship_ids_by_pair(
+        pair[0] for pair in pairs.values())
+    new_pairs = {}
+    for index, pair in pairs.items():
+        if pair not in relationship_ids and pair not in new_pairs:
+            new_pairs[pair] = get_record_data(
+                model.SubstanceRelationships,
+                get_new_substance_relationship_data(*pair))
+            created.add(index)
+    insert_missing(model.SubstanceRelationships.__table__,
+                   list(new_pairs.values()))
+    if new_pairs:
+        relationship_ids = get_substance_relationship_ids_by_pair(
+            pair[0] for pair in pairs.values())
+    relationship_ids = {index: relationship_ids[pair]
+                        for index, pair in pairs.items()}
+    # kinetics
+    kinetics_data = {}
+    for index in pairs:
+        payload = payloads[index]
+        if any([payload.get(column) for column in KINETIC_DATA]):
+            data = dict(payload)
+            data['fk_substance_relationship_id'] = relationship_ids[index]
+            kinetics_data[index] = get_record_data(model.Kinetics, data)
+    kinetics_ids = get_ids_by_hash(
+        model.Kinetics,
+        [data['content_hash'] for data in kinetics_data.values()])
+    new_kinetics = {}
+    for index, data in kinetics_data.items():
+        content_hash = data['content_hash']
+        if content_hash not in kinetics_ids \
+                and content_hash not in new_kinetics:
+            new_kinetics[content_hash] = data
+            created.add(index)
+    insert_missing(model.Kinetics.__table__, list(new_kinetics.values()))
+    kinetics_ids.update(get_ids_by_hash(model.Kinetics, new_kinetics))
+    # citations and their authors
+    citation_data = {index: get_record_data(model.Citation, payloads[index])
+                     for index in pairs}
+    citation_ids = get_ids_by_hash(
+        model.Citation,
+        [data['content_hash'] for data in citation_data.values()])
+    new_citations = {}
+    citation_authors = {}
+    for index, data in citation_data.items():
+        content_hash = data['content_hash']
+        if content_hash not in citation_ids \
+                and content_hash not in new_citations:
+            new_citations[content_hash] = data
+            citation_authors[content_hash] = \
+                get_authors_data(payloads[index])
+            created.add(index)
+    insert_missing(model.Citation.__table__, list(new_citations.values()))
+    citation_ids.update(get_ids_by_hash(model.Citation, new_citations))
+    map_authors({citation_ids[content_hash]: authors
+                 for content_hash, authors in citation_authors.items()})
+    # transformation citation mappings
+    mapping = model.transformation_cited.c
+    existing_mappings = set(
+        db.session.query(
+                mapping.fk_substance_relationship_id,
+                mapping.fk_kinetics_id,
+                mapping.fk_citation_id
+                )
+            .filter(mapping.fk_substance_relationship_id
+                    .in_(set(relationship_ids.values())))
+            .all()
+        )
+    new_mappings = {}
+    for index in pairs:
+        mapping_key = (
+            relationship_ids[index],
+            kinetics_ids.get(
+                kinetics_data.get(index, {}).get('content_hash')),
+            citation_ids[citation_data[index]['content_hash']]
+            )
+        if mapping_key not in existing_mappings \
+                and mapping_key not in new_mappings:
+            new_mappings[mapping_key] = dict(zip(
+                ('fk_substance_relationship_id', 'fk_kinetics_id',
+                 'fk_citation_id'), mapping_key))
+            created.add(index)
+    insert_missing(model.transformation_cited, list(new_mappings.values()))
+    refresh_transformation_mv(relationship_ids[index] for index in created)
+    db.session.commit()
+    # The relationships were inserted without the ORM.
+    pathway_graph.mark_stale()
+    response_cache.invalidate(*WRITTEN_ENTITIES)
+    for index in pairs:
+        statuses[index] = 'created' if index in created else 'exists'
+    response = jsonify([{'status': status} for status in statuses])
+    response.status_code = 200
+    return response
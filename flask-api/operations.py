@@ -1,3 +1,5 @@
+from typing import Optional, Set
+
 from flask import Response
 
 import model
@@ -6,7 +8,14 @@ from responses import (
     entity_post_response, entity_get_response,
     record_id_get_response, record_id_put_response,
     record_id_patch_response, record_id_delete_response,
-    entity_search_response
+    entity_search_response, entity_export_response,
+    record_id_blob_response
+    )
+from pathway_graph import pathways_response
+from replicas import replica_router
+from response_cache import response_cache
+from transformation_mv import (
+    get_substance_relationship_ids, refresh_transformation_mv
     )
 
 
@@ -19,12 +28,29 @@ class View:
                  schema: ma.SQLAlchemyAutoSchema):
         self.entity = entity
         self.schema = schema
+        self.includes = model.INCLUDES.get(entity, {})
 
     def get(self) -> Response:
-        return entity_get_response(self.entity, self.schema)
+        with replica_router.reading(db.session):
+            return response_cache.get_response(
+                self.entity,
+                lambda: entity_get_response(
+                    self.entity, self.schema, self.includes),
+                self.includes
+                )
 
     def search(self) -> Response:
-        return entity_search_response(self.entity, self.schema)
+        with replica_router.reading(db.session):
+            return response_cache.get_response(
+                self.entity,
+                lambda: entity_search_response(
+                    self.entity, self.schema, self.includes),
+                self.includes
+                )
+
+    def export(self) -> Response:
+        return entity_export_response(
+            self.entity, self.schema, self.includes)
 
 
 class Entity(View):
@@ -33,28 +59,99 @@ class Entity(View):
     be performed on a database entity by the API
     """
     def get_record(self, primary_key: int) -> Response:
-        return record_id_get_response(primary_key, self.entity, self.schema)
+        with replica_router.reading(db.session):
+            return response_cache.get_response(
+                self.entity,
+                lambda: record_id_get_response(
+                    primary_key, self.entity, self.schema, self.includes),
+                self.includes
+                )
 
     def post(self) -> Response:
-        return entity_post_response(self.entity, self.schema)
+        response = entity_post_response(
+            self.entity, self.schema, before_commit=self.refresh)
+        if response.status_code == 201:
+            self.invalidate()
+        return response
 
     def put(self, primary_key: int) -> Response:
-        return record_id_put_response(primary_key, self.entity, self.schema)
+        affected = get_substance_relationship_ids(self.entity, primary_key)
+        response = record_id_put_response(
+            primary_key, self.entity, self.schema,
+            lambda record_id: self.refresh(record_id, affected))
+        if response.status_code in (200, 201):
+            self.invalidate()
+        return response
 
     def patch(self, primary_key: int) -> Response:
-        return record_id_patch_response(primary_key, self.entity, self.schema)
+        affected = get_substance_relationship_ids(self.entity, primary_key)
+        response = record_id_patch_response(
+            primary_key, self.entity, self.schema,
+            lambda record_id: self.refresh(record_id, affected))
+        if response.status_code == 200:
+            self.invalidate()
+        return response
 
     def delete(self, primary_key: int) -> Response:
-        return record_id_delete_response(primary_key, self.entity)
+        affected = get_substance_relationship_ids(self.entity, primary_key)
+        response = record_id_delete_response(
+            primary_key, self.entity,
+            lambda record_id: refresh_transformation_mv(affected))
+        if response.status_code == 200:
+            self.invalidate()
+        return response
+
+    def refresh(self, primary_key: int,
+                affected: Optional[Set[int]] = None) -> None:
+        # This runs before the write is committed. The rows that
+        # depended on the record before the write are refreshed
+        # along with those that depend on it now.
+        refresh_transformation_mv(
+            (affected or set()) | get_substance_relationship_ids(
+                self.entity, primary_key)
+            )
+        return None
+
+    def invalidate(self) -> None:
+        response_cache.invalidate(self.entity, model.TransformationMv)
+        return None
+
+
+class Document(Entity):
+    """
+    This class adds streaming of a file stored in a
+    binary column to the methods of a database entity
+    """
+    def __init__(self, entity: db.Model,
+                 schema: ma.SQLAlchemyAutoSchema,
+                 column_name: str, mimetype: str):
+        super().__init__(entity, schema)
+        self.column_name = column_name
+        self.mimetype = mimetype
+
+    def get_blob(self, primary_key: int) -> Response:
+        return record_id_blob_response(
+            primary_key, self.entity, self.column_name, self.mimetype)
+
+
+class Substance(Entity):
+    """
+    This class adds the traversal of the transformation
+    pathways to the methods of a database entity
+    """
+    def get_pathways(self, primary_key: int, direction: str = 'descendants',
+                     depth: int = 3) -> Response:
+        return pathways_response(primary_key, direction, depth)
 
 
 transformation_view = View(
-    model.TransformationView, model.TransformationViewSchema)
+    model.TransformationMv, model.TransformationMvSchema)
 kinetics = Entity(model.Kinetics, model.KineticsSchema)
 substance_relationships = Entity(
     model.SubstanceRelationships, model.SubstanceRelationshipsSchema)
-generic_substances = Entity(
+generic_substances = Substance(
     model.GenericSubstances, model.GenericSubstancesSchema)
 compounds = Entity(model.Compounds, model.CompoundsSchema)
 author = Entity(model.Author, model.AuthorSchema)
-citation = Entity(model.Citation, model.CitationSchema)
+citation = Document(
+    model.Citation, model.CitationSchema, 'pdf', 'application/pdf')
@@ -0,0 +1,258 @@
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from flask import Response
+from sqlalchemy import func
+
+import model
+from config import app, db
+from serializer import dump_many, get_prefixes, get_serializer, json_response
+
+DIRECTIONS = ('descendants', 'ancestors')
+MAX_DEPTH = 10
+
+
+class Adjacency:
+    """
+    This class holds the edges of the graph in compressed sparse row
+    form, so the edges leaving a node are a slice of one array
+    """
+    def __init__(self, sources: np.ndarray, targets: np.ndarray,
+                 edge_ids: np.ndarray, node_count: int):
+        order = np.argsort(sources, kind='stable')
+        offsets = np.zeros(node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=node_count),
+                  out=offsets[1:])
+        # Lists index faster than arrays from Python code.
+        self.offsets = offsets.tolist()
+        self.targets = targets[order].tolist()
+        self.edge_ids = edge_ids[order].tolist()
+
+    def get_edges(self, node: int) -> Tuple[List[int], List[int]]:
+        start, stop = self.offsets[node], self.offsets[node + 1]
+        return self.targets[start:stop], self.edge_ids[start:stop]
+
+
+class PathwayGraph:
+    """
+    This class holds the predecessor to successor graph of the
+    transformation products in memory, and rebuilds it on the next
+    traversal after a relationship has been written by this worker,
+    after another worker changed their count or highest id, or
+    after the max age
+    """
+    def __init__(self, max_age: float, check_interval: float):
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.lock = Lock()
+        self.refresh_lock = Lock()
+        self.stale = True
+        self.version = None
+        self.loaded_at = None
+        self.checked_at = None
+        self.nodes = {}
+        self.substance_ids = []
+        self.adjacency = {}
+        self.edges = {}
+        self.load_seconds = None
+        self.refreshes = 0
+
+    @staticmethod
+    def get_query(*columns):
+        return db.session.query(*columns)\
+            .join(model.SubstanceRelationshipTypes,
+                  model.SubstanceRelationshipTypes.id
+                  == model.SubstanceRelationships
+                  .fk_substance_relationship_type_id)\
+            .filter(model.SubstanceRelationshipTypes.name
+                    == 'transformation_product')
+
+    def get_version(self) -> Tuple[int, Optional[int]]:
+        return tuple(self.get_query(
+            func.count(model.SubstanceRelationships.id),
+            func.max(model.SubstanceRelationships.id)
+            ).one())
+
+    def refresh(self) -> None:
+        started_at = monotonic()
+        with self.lock:
+            self.stale = False
+        # The version is read first, so that a relationship written
+        # during the rebuild is found by the next check.
+        version = self.get_version()
+        rows = self.get_query(
+                model.SubstanceRelationships.id,
+                model.SubstanceRelationships
+                    .fk_generic_substance_id_predecessor,
+                model.SubstanceRelationships
+                    .fk_generic_substance_id_successor
+                )\
+            .filter(model.SubstanceRelationships
+                    .fk_generic_substance_id_predecessor.isnot(None))\
+            .filter(model.SubstanceRelationships
+                    .fk_generic_substance_id_successor.isnot(None))\
+            .all()
+        edge_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        substances = np.array([row[1:] for row in rows],
+                              dtype=np.int64).reshape(-1, 2)
+        # The substance ids are numbered densely to index the offsets.
+        substance_ids, dense = np.unique(substances, return_inverse=True)
+        dense = dense.reshape(-1, 2)
+        adjacency = {
+            'descendants': Adjacency(dense[:, 0], dense[:, 1], edge_ids,
+                                     len(substance_ids)),
+            'ancestors': Adjacency(dense[:, 1], dense[:, 0], edge_ids,
+                                   len(substance_ids))
+            }
+        edges = {edge_id: pair for edge_id, pair
+                 in zip(edge_ids.tolist(), substances.tolist())}
+        with self.lock:
+            self.substance_ids = substance_ids.tolist()
+            self.nodes = {substance_id: node for node, substance_id
+                          in enumerate(self.substance_ids)}
+            self.adjacency = adjacency
+            self.edges = edges
+            self.version = version
+            self.loaded_at = self.checked_at = started_at
+            self.load_seconds = monotonic() - started_at
+            self.refreshes += 1
+        return None
+
+    def is_current(self) -> bool:
+        now = monotonic()
+        with self.lock:
+            if self.stale or now - self.loaded_at >= self.max_age:
+                return False
+            if now - self.checked_at < self.check_interval:
+                return True
+            # The check is claimed so that one request at a time runs it.
+            self.checked_at = now
+            version = self.version
+        return self.get_version() == version
+
+    def mark_stale(self) -> None:
+        with self.lock:
+            self.stale = True
+        return None
+
+    def after_flush(self, session, flush_context) -> None:
+        for record in (*session.new, *session.dirty, *session.deleted):
+            if isinstance(record, model.SubstanceRelationships):
+                session.info['pathways_changed'] = True
+                break
+        return None
+
+    def after_commit(self, session) -> None:
+        # The graph is only marked once the rows can be read back,
+        # so a concurrent rebuild cannot miss a relationship.
+        if session.info.pop('pathways_changed', False):
+            self.mark_stale()
+        return None
+
+    def listen(self) -> None:
+        db.event.listen(db.session, 'after_flush', self.after_flush)
+        db.event.listen(db.session, 'after_commit', self.after_commit)
+        return None
+
+    def traverse(
+            self, substance_id: int, direction: str, max_depth: int
+            ) -> Optional[List[Tuple[int, int, int, int]]]:
+        # This returns the id, depth, predecessor and successor
+        # of each relationship reached breadth first.
+        if not self.is_current():
+            # One request rebuilds the graph while the others traverse
+            # the previous one, and they only wait for the first load.
+            loaded_at = self.loaded_at
+            if self.refresh_lock.acquire(blocking=loaded_at is None):
+                try:
+                    if self.loaded_at == loaded_at:
+                        self.refresh()
+                finally:
+                    self.refresh_lock.release()
+        with self.lock:
+            nodes, edges = self.nodes, self.edges
+            adjacency = self.adjacency[direction]
+        if substance_id not in nodes:
+            return None
+        visited = {nodes[substance_id]}
+        frontier = [nodes[substance_id]]
+        reached = []
+        for depth in range(1, max_depth + 1):
+            next_frontier = []
+            for node in frontier:
+                targets, edge_ids = adjacency.get_edges(node)
+                for target, edge_id in zip(targets, edge_ids):
+                    reached.append((edge_id, depth, *edges[edge_id]))
+                    if target not in visited:
+                        visited.add(target)
+                        next_frontier.append(target)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return reached
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'substances': len(self.substance_ids),
+                'relationships': len(self.edges),
+                'stale': self.stale,
+                'version': self.version,
+                'refreshes': self.refreshes,
+                'load_seconds': self.load_seconds
+                }
+
+
+pathway_graph = PathwayGraph(
+    app.config['PATHWAY_GRAPH_MAX_AGE'],
+    app.config['PATHWAY_GRAPH_CHECK_INTERVAL']
+    )
+pathway_graph.listen()
+
+
+def pathways_response(primary_key: int, direction: str,
+                      depth: int) -> Response:
+    if direction not in DIRECTIONS or depth < 1 or depth > MAX_DEPTH:
+        response = Response('The URL parameter(s) are incorrect '
+                            'or not specified.', status=400)
+        return response
+    reached = pathway_graph.traverse(primary_key, direction, depth)
+    if reached is None:
+        if not db.session.query(model.GenericSubstances.id)\
+                .filter(model.GenericSubstances.id == primary_key)\
+                .one_or_none():
+            response = Response('Record not found.', status=404)
+            return response
+        reached = []
+    # The kinetics of every relationship are read in one query.
+    kinetics = {}
+    records = model.Kinetics.query\
+        .filter(model.Kinetics.fk_substance_relationship_id
+                .in_([edge_id for edge_id, _, _, _ in reached]))\
+        .order_by(model.Kinetics.id)\
+        .all()
+    for record, data in zip(records, dump_many(model.KineticsSchema,
+                                               records)):
+        kinetics.setdefault(
+            record.fk_substance_relationship_id, []).append(data)
+    serialize = get_serializer(model.SubstanceRelationshipsSchema)
+    prefix, suffix = get_prefixes(serialize)[serialize.endpoints[0]]
+    response = json_response({
+        'generic_substance_id': primary_key,
+        'direction': direction,
+        'depth': depth,
+        'relationships': [
+            {'id': edge_id,
+             'depth': edge_depth,
+             'predecessor_id': predecessor_id,
+             'successor_id': successor_id,
+             'uri': prefix + str(edge_id) + suffix,
+             'kinetics': kinetics.get(edge_id, [])}
+            for edge_id, edge_depth, predecessor_id, successor_id
+            in reached
+            ]
+        })
+    response.status_code = 200
+    return response
@@ -0,0 +1,160 @@
+import json
+import logging
+from collections import Counter
+from random import random
+from threading import Lock
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+from connexion.apis.flask_utils import flaskify_endpoint
+from flask import Flask, g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import app
+
+logger = logging.getLogger(__name__)
+
+SLOWEST_COUNT = 5
+# A statement run this many times in one request is reported as N+1.
+REPEAT_THRESHOLD = 5
+STATEMENT_LENGTH = 200
+
+
+class QueryRecorder:
+    """
+    This class records the statements that each request runs through
+    the engine events, reports them in the response headers and in a
+    sampled log, and aggregates them by connexion operationId
+    """
+    def __init__(self, sample_rate: float, slow_seconds: float):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.lock = Lock()
+        self.operation_ids = {}
+        self.operations = {}
+
+    def init_app(self, flask_app: Flask) -> None:
+        event.listen(Engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute',
+                     self.after_cursor_execute)
+        flask_app.before_request(self.start)
+        flask_app.after_request(self.finish)
+        return None
+
+    def register_api(self, api) -> None:
+        # Connexion names the flask endpoint after the operationId,
+        # so this maps the endpoint of a request back to it.
+        for methods in api.specification['paths'].values():
+            for operation in methods.values():
+                if isinstance(operation, dict) and 'operationId' in operation:
+                    operation_id = operation['operationId']
+                    endpoint = '{}.{}'.format(
+                        api.blueprint.name, flaskify_endpoint(operation_id))
+                    self.operation_ids[endpoint] = operation_id
+        return None
+
+    def get_operation_id(self) -> str:
+        endpoint = request.endpoint or request.path
+        return self.operation_ids.get(endpoint, endpoint)
+
+    @staticmethod
+    def start() -> None:
+        g.queries = []
+        return None
+
+    @staticmethod
+    def before_cursor_execute(conn, cursor, statement, parameters,
+                              context, executemany) -> None:
+        # The start is kept on the execution context, which is dropped
+        # with the statement even when it fails before it finishes.
+        if context is not None:
+            context.query_started_at = perf_counter()
+        return None
+
+    @staticmethod
+    def after_cursor_execute(conn, cursor, statement, parameters,
+                             context, executemany) -> None:
+        started_at = getattr(context, 'query_started_at', None)
+        if started_at is None:
+            return None
+        duration = perf_counter() - started_at
+        # Statements run outside of a request, or by a streamed
+        # response after it has been returned, are not recorded.
+        if has_request_context() and 'queries' in g:
+            g.queries.append((statement, duration))
+        return None
+
+    def finish(self, response: Response) -> Response:
+        queries = g.pop('queries', None)
+        if queries is None:
+            return response
+        operation_id = self.get_operation_id()
+        db_seconds = sum(duration for _, duration in queries)
+        repeated = {
+            statement: count
+            for statement, count in Counter(
+                statement for statement, _ in queries).items()
+            if count >= REPEAT_THRESHOLD
+            }
+        response.headers['X-DB-Query-Count'] = str(len(queries))
+        response.headers.add(
+            'Server-Timing',
+            'db;dur={:.1f};desc="{} queries"'
+            .format(db_seconds * 1000, len(queries))
+            )
+        self.record(operation_id, len(queries), db_seconds, bool(repeated))
+        if db_seconds >= self.slow_seconds or random() < self.sample_rate:
+            logger.info(json.dumps({
+                'operation_id': operation_id,
+                'method': request.method,
+                'path': request.full_path,
+                'status': response.status_code,
+                'statements': len(queries),
+                'db_seconds': round(db_seconds, 6),
+                'slowest': self.get_slowest(queries),
+                'repeated': [
+                    {'statement': statement[:STATEMENT_LENGTH],
+                     'count': count}
+                    for statement, count in repeated.items()
+                    ]
+                }))
+        return response
+
+    @staticmethod
+    def get_slowest(queries: List[Tuple[str, float]]) -> List[Dict]:
+        slowest = sorted(queries, key=lambda query: query[1],
+                         reverse=True)[:SLOWEST_COUNT]
+        return [{'statement': statement[:STATEMENT_LENGTH],
+                 'seconds': round(duration, 6)}
+                for statement, duration in slowest]
+
+    def record(self, operation_id: str, statements: int,
+               db_seconds: float, repeated: bool) -> None:
+        with self.lock:
+            operation = self.operations.setdefault(operation_id, {
+                'requests': 0, 'statements': 0, 'max_statements': 0,
+                'db_seconds': 0.0, 'max_db_seconds': 0.0,
+                'repeated_statement_requests': 0
+                })
+            operation['requests'] += 1
+            operation['statements'] += statements
+            operation['max_statements'] = max(
+                operation['max_statements'], statements)
+            operation['db_seconds'] += db_seconds
+            operation['max_db_seconds'] = max(
+                operation['max_db_seconds'], db_seconds)
+            operation['repeated_statement_requests'] += repeated
+        return None
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {operation_id: dict(operation)
+                    for operation_id, operation in self.operations.items()}
+
+
+query_recorder = QueryRecorder(
+    app.config['QUERY_LOG_SAMPLE_RATE'],
+    app.config['QUERY_LOG_SLOW_SECONDS']
+    )
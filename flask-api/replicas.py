@@ -0,0 +1,237 @@
+import logging
+from contextlib import contextmanager
+from itertools import count
+from math import ceil
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Dict, Iterator, List, Optional
+
+from flask import Flask, g, has_request_context, request, Response
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm, text
+
+logger = logging.getLogger(__name__)
+
+# The responses of requests that wrote set this cookie, so that the
+# next requests of the client read from the primary in any worker.
+STICKY_COOKIE = 'read_primary'
+
+
+class RoutingSession(SignallingSession):
+    """
+    This session sends its statements to the read replica
+    set in its info, and to the primary database otherwise
+    """
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is not None:
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    This class creates the scoped session of the
+    application from the routing session
+    """
+    def create_session(self, options: Dict) -> orm.sessionmaker:
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class Replica:
+    """
+    This class holds the engine of a read replica
+    and the outcome of its last health check
+    """
+    def __init__(self, uri: str, engine_options: Dict):
+        self.engine = create_engine(uri, **engine_options)
+        self.healthy = False
+        self.reads = 0
+        self.failures = 0
+        self.last_error = None
+        event.listen(self.engine, 'handle_error', self.handle_error)
+
+    def check(self) -> bool:
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except Exception as e:
+            self.mark_down(str(e))
+            return False
+        self.healthy = True
+        self.last_error = None
+        return True
+
+    def mark_down(self, error: str) -> None:
+        if self.healthy:
+            logger.warning('Read replica %r is down: %s',
+                           self.engine.url, error)
+        self.healthy = False
+        self.failures += 1
+        self.last_error = error
+        return None
+
+    def handle_error(self, context) -> None:
+        # A lost connection takes the replica out of the rotation
+        # until the next health check finds it up again.
+        if context.is_disconnect:
+            self.mark_down(str(context.original_exception))
+        return None
+
+    def stats(self) -> Dict:
+        return {
+            'uri': repr(self.engine.url),
+            'healthy': self.healthy,
+            'reads': self.reads,
+            'failures': self.failures,
+            'last_error': self.last_error
+            }
+
+
+class ReplicaRouter:
+    """
+    This class routes read operations to the healthy read replicas in
+    turn, and keeps them on the primary database while the session
+    has written, shortly after this process committed a write, or
+    shortly after the client of the request made one
+    """
+    def __init__(self, check_interval: float = 5.0,
+                 sticky_seconds: float = 5.0):
+        self.check_interval = check_interval
+        self.sticky_seconds = sticky_seconds
+        self.lock = Lock()
+        self.replicas = []
+        self.turns = count()
+        self.written_at = None
+        self.primary_reads = 0
+        self.stopped = Event()
+        self.monitor = None
+
+    def init_app(self, flask_app: Flask) -> None:
+        flask_app.after_request(self.set_cookie)
+        return None
+
+    def configure(self, uris: List[str], engine_options: Dict,
+                  sticky_seconds: float) -> None:
+        self.sticky_seconds = sticky_seconds
+        replicas = [Replica(uri, engine_options) for uri in uris]
+        for replica in replicas:
+            replica.check()
+        with self.lock:
+            replicas, self.replicas = self.replicas, replicas
+        for replica in replicas:
+            replica.engine.dispose()
+        if self.replicas and self.monitor is None:
+            self.monitor = Thread(target=self.supervise, daemon=True)
+            self.monitor.start()
+        return None
+
+    def supervise(self) -> None:
+        while not self.stopped.wait(self.check_interval):
+            with self.lock:
+                replicas = list(self.replicas)
+            for replica in replicas:
+                if not replica.healthy:
+                    replica.check()
+        return None
+
+    def dispose(self) -> None:
+        # Connections opened through a restarted tunnel are dead.
+        with self.lock:
+            replicas = list(self.replicas)
+        for replica in replicas:
+            replica.engine.dispose()
+        return None
+
+    def stop(self) -> None:
+        self.stopped.set()
+        return None
+
+    def choose(self) -> Optional[Replica]:
+        with self.lock:
+            replicas = self.replicas
+            if not replicas:
+                return None
+            start = next(self.turns)
+        for offset in range(len(replicas)):
+            replica = replicas[(start + offset) % len(replicas)]
+            if replica.healthy:
+                return replica
+        return None
+
+    @staticmethod
+    def has_client_written() -> bool:
+        return has_request_context() \
+            and STICKY_COOKIE in request.cookies
+
+    def is_sticky(self, session: orm.Session) -> bool:
+        if session.info.get('written') \
+                or session.new or session.dirty or session.deleted \
+                or self.has_client_written():
+            return True
+        written_at = self.written_at
+        return written_at is not None \
+            and monotonic() - written_at < self.sticky_seconds
+
+    @contextmanager
+    def reading(self, session: orm.Session) -> Iterator[None]:
+        # The session is routed for the duration of the block only.
+        replica = None if self.is_sticky(session) else self.choose()
+        if replica is None:
+            self.primary_reads += 1
+            yield
+            return
+        replica.reads += 1
+        session.info['replica'] = replica.engine
+        try:
+            yield
+        finally:
+            session.info.pop('replica', None)
+
+    def after_flush(self, session, flush_context) -> None:
+        session.info['written'] = True
+        return None
+
+    def do_orm_execute(self, execute_state) -> None:
+        # The core inserts and updates of the bulk
+        # post are executed without being flushed.
+        if not execute_state.is_select:
+            execute_state.session.info['written'] = True
+        return None
+
+    def after_commit(self, session) -> None:
+        if session.info.pop('written', False):
+            self.written_at = monotonic()
+            if has_request_context():
+                g.replica_written = True
+        return None
+
+    def after_rollback(self, session) -> None:
+        session.info.pop('written', None)
+        return None
+
+    def set_cookie(self, response: Response) -> Response:
+        if g.pop('replica_written', False):
+            response.set_cookie(
+                STICKY_COOKIE, '1', max_age=ceil(self.sticky_seconds),
+                httponly=True, samesite='Lax')
+        return response
+
+    def listen(self, session: orm.scoped_session) -> None:
+        for event_name in ('after_flush', 'do_orm_execute', 'after_commit',
+                           'after_rollback'):
+            event.listen(session, event_name, getattr(self, event_name))
+        return None
+
+    def stats(self) -> Dict:
+        with self.lock:
+            replicas = list(self.replicas)
+        return {
+            'replicas': [replica.stats() for replica in replicas],
+            'primary_reads': self.primary_reads,
+            'sticky_seconds': self.sticky_seconds
+            }
+
+
+replica_router = ReplicaRouter()
+
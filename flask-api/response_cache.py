@@ -0,0 +1,165 @@
+from collections import OrderedDict
+from hashlib import sha1
+from multiprocessing import Array
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, Optional, Set, Tuple
+from zlib import crc32
+
+from flask import Response, request
+
+from config import app, db
+from replicas import replica_router
+
+CACHED_HEADERS = ('Link',)
+# The tables are hashed into this many invalidation counters. Tables
+# that share a counter only drop each other's responses more often.
+GENERATION_SLOTS = 256
+
+
+class ResponseCache:
+    """
+    This class caches successful read responses in a size-bounded LRU
+    keyed by the request URL, answers conditional requests with strong
+    ETags, and drops the responses of an entity when it is written by
+    any of the workers forked from the process that created it
+    """
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.tags = {}
+        # This counts the invalidations of each tag in shared memory,
+        # which the gunicorn workers inherit from the preloaded app.
+        # A response is only served while the counters of its tags
+        # are those read before it was computed.
+        self.generations = Array('Q', GENERATION_SLOTS)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def get_tags(entity: db.Model, includes: Optional[Dict]) -> Set[str]:
+        # A response that nests related records is also dropped
+        # when the table of any of those records is written.
+        tags = {entity.__tablename__}
+        for name in request.args.get('include', '').split(','):
+            if includes and name in includes:
+                tags.add(includes[name].Meta.model.__tablename__)
+        return tags
+
+    def get_response(self, entity: db.Model,
+                     compute: Callable[[], Response],
+                     includes: Optional[Dict] = None) -> Response:
+        tags = self.get_tags(entity, includes)
+        key = (
+            request.host_url, request.path,
+            tuple(sorted(request.args.items(multi=True)))
+            )
+        with self.lock:
+            generations = self.get_generations(tags)
+            entry = self.entries.get(key)
+            if entry and entry['generations'] != generations:
+                # Another worker has written one of its tables.
+                self.discard(key)
+                entry = None
+            # A client that has just written may find a response
+            # cached before its write, or read from a lagging replica,
+            # so its reads go to the primary and refresh the entry.
+            if replica_router.has_client_written():
+                entry = None
+                self.misses += 1
+            elif entry and entry['expires_at'] > monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+        if not entry:
+            response = compute()
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            body = response.get_data()
+            entry = {
+                'body': body,
+                'etag': sha1(body).hexdigest(),
+                'mimetype': response.mimetype,
+                'headers': {header: response.headers[header]
+                            for header in CACHED_HEADERS
+                            if header in response.headers},
+                'expires_at': monotonic() + self.ttl
+                }
+            self.store(tags, key, entry, generations)
+        if request.if_none_match.contains(entry['etag']):
+            response = Response(status=304)
+        else:
+            response = Response(entry['body'], mimetype=entry['mimetype'],
+                                headers=entry['headers'])
+            response.status_code = 200
+        response.set_etag(entry['etag'])
+        return response
+
+    @staticmethod
+    def get_slot(tag: str) -> int:
+        return crc32(tag.encode()) % GENERATION_SLOTS
+
+    def get_generations(self, tags: Set[str]) -> Tuple[int, ...]:
+        return tuple(self.generations[self.get_slot(tag)]
+                     for tag in sorted(tags))
+
+    def store(self, tags: Set[str], key: Tuple, entry: Dict,
+              generations: Tuple[int, ...]) -> None:
+        with self.lock:
+            # A response computed while one of its tables was written
+            # may predate the write, so it is not kept.
+            if self.get_generations(tags) != generations:
+                return None
+            self.discard(key)
+            self.entries[key] = entry
+            entry['tags'] = tags
+            entry['generations'] = generations
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            self.size += len(entry['body'])
+            while self.size > self.max_bytes and self.entries:
+                self.discard(next(iter(self.entries)))
+        return None
+
+    def discard(self, key: Tuple) -> None:
+        # This must be called while holding the lock.
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= len(entry['body'])
+            for tag in entry['tags']:
+                self.tags[tag].discard(key)
+        return None
+
+    def invalidate(self, *entities: db.Model) -> None:
+        with self.lock:
+            for entity in entities:
+                with self.generations.get_lock():
+                    self.generations[self.get_slot(entity.__tablename__)] += 1
+                for key in list(self.tags.get(entity.__tablename__, ())):
+                    self.discard(key)
+            self.invalidations += 1
+        return None
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations
+                }
+
+
+response_cache = ResponseCache(
+    app.config['RESPONSE_CACHE_MAX_BYTES'],
+    app.config['RESPONSE_CACHE_TTL']
+    )
@@ -1,7 +1,39 @@
+import csv
 import json
+import re
+from hashlib import sha256
+from io import StringIO
 from config import db, ma
-from flask import jsonify, Response, request
-from typing import Dict, List, Optional, Union
+from flask import Response, request, stream_with_context
+from search_report import search_report
+from serializer import (
+    dump, dump_many, dumps, get_field_attributes, get_prefixes,
+    get_serializer, json_response
+    )
+from sqlalchemy import func
+from sqlalchemy.orm import load_only, selectinload
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlencode
+
+PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 500
+BLOB_CHUNK_SIZE = 1 << 20
+# A search argument is either a column name or column[operator].
+SEARCH_ARGUMENT = re.compile(r'^(?P<label>.+?)(?:\[(?P<operator>\w+)\])?$')
+SEARCH_OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'in': lambda column, values: column.in_(values),
+    # A pattern anchored at the start can seek on the index.
+    'prefix': lambda column, value: column.like(
+        value.replace('\\', '\\\\').replace('%', '\\%')
+        .replace('_', '\\_') + '%',
+        escape='\\')
+    }
 
 
 def get_features_except_id(
@@ -10,14 +42,50 @@ def get_features_except_id(
     features = dict(entity.__table__.columns.items())
     for label in skip:
         del features[label]
-    if 'id' in features:
-        del features['id']
+    for label in ('id', 'content_hash'):
+        if label in features:
+            del features[label]
     return features
 
 
+def coerce_value(column: db.Column, value):
+    python_type = column.type.python_type
+    if python_type is bytes and isinstance(value, str):
+        return value.encode()
+    return python_type(value)
+
+
+def get_feature_key(entity: db.Model, data: Dict) -> Tuple:
+    # This coerces the values to the column types so that payloads
+    # can be compared with rows that were read from the database.
+    key = []
+    for label, column in get_features_except_id(entity).items():
+        value = data.get(label)
+        if value is not None:
+            try:
+                value = coerce_value(column, value)
+            except (TypeError, ValueError):
+                pass
+        key.append(value)
+    return tuple(key)
+
+
+def get_content_hash(entity: db.Model, data: Dict) -> str:
+    key = json.dumps(get_feature_key(entity, data),
+                     default=lambda value: value.hex())
+    return sha256(key.encode()).hexdigest()
+
+
 def query_payload(
         entity: db.Model, payload: Dict
         ) -> Union[db.Model, None]:
+    if 'content_hash' in entity.__table__.columns:
+        # This probes the unique index on the hash of the
+        # normalized content instead of comparing every column.
+        return entity.query\
+            .filter(entity.content_hash
+                    == get_content_hash(entity, payload))\
+            .one_or_none()
     filters = []
     for label, column in get_features_except_id(entity).items():
         value = payload.get(label)
@@ -25,21 +93,156 @@ def query_payload(
     return entity.query.filter(*filters).one_or_none()
 
 
-def entity_get_response(
-        entity: db.Model,
-        schema: ma.SQLAlchemyAutoSchema
+def get_page_parameters(
+        parameters: Dict
+        ) -> Union[Tuple[Optional[int], int], None]:
+    # This removes the paging arguments so that
+    # only the column filters remain in parameters.
+    after = parameters.pop('after', None)
+    page_size = parameters.pop('page_size', PAGE_SIZE)
+    try:
+        after = int(after) if after is not None else None
+        page_size = int(page_size)
+    except ValueError:
+        return None
+    if page_size < 1 or page_size > PAGE_SIZE:
+        return None
+    return after, page_size
+
+
+def get_field_parameters(
+        parameters: Dict,
+        schema: ma.SQLAlchemyAutoSchema,
+        includes: Dict
+        ) -> Union[Tuple[Optional[Tuple[str, ...]], Dict], None]:
+    # This removes the field selection arguments so that
+    # only the column filters remain in parameters.
+    fields = parameters.pop('fields', None)
+    names = parameters.pop('include', None)
+    if fields is not None:
+        fields = tuple(dict.fromkeys(
+            field for field in fields.split(',') if field))
+        if not fields or not set(fields) <= set(get_field_attributes(schema)):
+            return None
+    included = {}
+    if names is not None:
+        for name in names.split(','):
+            if name not in includes:
+                return None
+            included[name] = includes[name]
+    return fields, included
+
+
+def select_fields(
+        entity: db.Model, query: db.Query,
+        schema: ma.SQLAlchemyAutoSchema,
+        fields: Optional[Tuple[str, ...]], included: Dict
+        ) -> db.Query:
+    # Only the requested columns are read, and related records
+    # are loaded in one extra query per requested relationship.
+    if fields:
+        attributes = get_field_attributes(schema)
+        columns = entity.__mapper__.column_attrs.keys()
+        loaded = [getattr(entity, attributes[field]) for field in fields
+                  if attributes[field] in columns]
+        if loaded:
+            query = query.options(load_only(*loaded))
+    for name in included:
+        query = query.options(selectinload(getattr(entity, name)))
+    return query
+
+
+def get_search_filters(
+        entity: db.Model, parameters: Dict
+        ) -> Union[List, None]:
+    # This compiles arguments such as pH[gte]=6 into predicates
+    # on the column, with the values coerced to its type.
+    features = get_features_except_id(entity)
+    filters = []
+    for argument, value in parameters.items():
+        match = SEARCH_ARGUMENT.match(argument)
+        label, operator = match.group('label'), match.group('operator')
+        operator = operator or 'eq'
+        column = features.get(label)
+        if column is None or operator not in SEARCH_OPERATORS:
+            return None
+        try:
+            if operator == 'in':
+                value = [coerce_value(column, item)
+                         for item in value.split(',')]
+            elif operator == 'prefix':
+                if column.type.python_type is not str:
+                    return None
+            else:
+                value = coerce_value(column, value)
+        except (TypeError, ValueError):
+            return None
+        filters.append(
+            (column, operator, SEARCH_OPERATORS[operator](column, value)))
+    for column, operator, _ in filters:
+        search_report.record(entity.__tablename__, column.name, operator)
+    return [predicate for _, _, predicate in filters]
+
+
+def get_page(
+        entity: db.Model, query: db.Query,
+        after: Optional[int], page_size: int
+        ) -> Tuple[List[db.Model], Optional[int]]:
+    # Keyset pagination seeks on the primary key index,
+    # so every page costs the same regardless of depth.
+    if 'id' not in entity.__table__.columns:
+        raise ValueError('{} has no id column to page on.'.format(
+            entity.__name__))
+    if after is not None:
+        query = query.filter(entity.id > after)
+    records = query.order_by(entity.id).limit(page_size + 1).all()
+    if len(records) > page_size:
+        del records[page_size:]
+        return records, records[-1].id
+    return records, None
+
+
+def page_response(
+        records: List[db.Model],
+        schema: ma.SQLAlchemyAutoSchema,
+        cursor: Optional[int],
+        fields: Optional[Tuple[str, ...]] = None,
+        included: Optional[Dict] = None
         ) -> Response:
-    select_all = entity.query.limit(1000).all()
-    entity_schema = schema(many=True)
-    response = jsonify(entity_schema.dump(select_all))
+    response = json_response(dump_many(schema, records, fields, included))
     response.status_code = 200
+    if cursor is not None:
+        parameters = request.args.to_dict()
+        parameters['after'] = cursor
+        response.headers['Link'] = '<{url}?{query}>; rel="next"'.format(
+            url=request.base_url, query=urlencode(parameters))
     return response
 
 
+def entity_get_response(
+        entity: db.Model,
+        schema: ma.SQLAlchemyAutoSchema,
+        includes: Optional[Dict] = None
+        ) -> Response:
+    if includes is None:
+        includes = {}
+    parameters = request.args.to_dict()
+    page_parameters = get_page_parameters(parameters)
+    field_parameters = get_field_parameters(parameters, schema, includes)
+    if not page_parameters or not field_parameters:
+        response = Response('The URL parameter(s) are incorrect '
+                            'or not specified.', status=400)
+        return response
+    query = select_fields(entity, entity.query, schema, *field_parameters)
+    records, cursor = get_page(entity, query, *page_parameters)
+    return page_response(records, schema, cursor, *field_parameters)
+
+
 def entity_post_response(
         entity: db.Model,
         schema: ma.SQLAlchemyAutoSchema,
-        primary_key: Optional[int] = None
+        primary_key: Optional[int] = None,
+        before_commit: Optional[Callable[[int], None]] = None
         ) -> Response:
     payload = json.loads(request.get_json())
     record_already_exists = query_payload(entity, payload)
@@ -53,8 +256,13 @@ def entity_post_response(
     if primary_key and request.method == 'PUT':
         new_record.id = primary_key
     db.session.add(new_record)
+    db.session.flush()
+    # The hook runs in the transaction of the write, so that
+    # if it fails the write is rolled back along with it.
+    if before_commit:
+        before_commit(new_record.id)
     db.session.commit()
-    response = jsonify(entity_schema.dump(new_record))
+    response = json_response(dump(schema, new_record))
     response.status_code = 201
     return response
 
@@ -62,16 +270,24 @@ def entity_post_response(
 def record_id_get_response(
         primary_key: int,
         entity: db.Model,
-        schema: ma.SQLAlchemyAutoSchema
+        schema: ma.SQLAlchemyAutoSchema,
+        includes: Optional[Dict] = None
         ) -> Response:
-    record = entity.query\
+    if includes is None:
+        includes = {}
+    field_parameters = get_field_parameters(
+        request.args.to_dict(), schema, includes)
+    if not field_parameters:
+        response = Response('The URL parameter(s) are incorrect '
+                            'or not specified.', status=400)
+        return response
+    record = select_fields(entity, entity.query, schema, *field_parameters)\
         .filter(entity.id == primary_key) \
         .one_or_none()
     if not record:
         response = Response('Record not found.', status=404)
         return response
-    entity_schema = schema()
-    response = jsonify(entity_schema.dump(record))
+    response = json_response(dump(schema, record, *field_parameters))
     response.status_code = 200
     return response
 
@@ -79,13 +295,15 @@ def record_id_get_response(
 def record_id_put_response(
         primary_key: int,
         entity: db.Model,
-        schema: ma.SQLAlchemyAutoSchema
+        schema: ma.SQLAlchemyAutoSchema,
+        before_commit: Optional[Callable[[int], None]] = None
         ) -> Response:
     record_to_update = entity.query\
         .filter(entity.id == primary_key)\
         .one_or_none()
     if not record_to_update:
-        return entity_post_response(entity, schema, primary_key)
+        return entity_post_response(
+            entity, schema, primary_key, before_commit)
     payload = json.loads(request.get_json())
     existing_record = query_payload(entity, payload)
     if existing_record and existing_record.id != primary_key:
@@ -95,8 +313,11 @@ def record_id_put_response(
     updated_record = entity_schema.load(payload, session=db.session)
     updated_record.id = record_to_update.id
     db.session.merge(updated_record)
+    db.session.flush()
+    if before_commit:
+        before_commit(primary_key)
     db.session.commit()
-    response = jsonify(entity_schema.dump(updated_record))
+    response = json_response(dump(schema, updated_record))
     response.status_code = 200
     return response
 
@@ -104,7 +325,8 @@ def record_id_put_response(
 def record_id_patch_response(
         primary_key: int,
         entity: db.Model,
-        schema: ma.SQLAlchemyAutoSchema
+        schema: ma.SQLAlchemyAutoSchema,
+        before_commit: Optional[Callable[[int], None]] = None
         ) -> Response:
     record_to_update = entity.query \
         .filter(entity.id == primary_key) \
@@ -124,15 +346,19 @@ def record_id_patch_response(
     updated_record = entity_schema.load(payload, session=db.session)
     updated_record.id = record_to_update.id
     db.session.merge(updated_record)
+    db.session.flush()
+    if before_commit:
+        before_commit(primary_key)
     db.session.commit()
-    response = jsonify(entity_schema.dump(updated_record))
+    response = json_response(dump(schema, updated_record))
     response.status_code = 200
     return response
 
 
 def record_id_delete_response(
         primary_key: int,
-        entity: db.Model
+        entity: db.Model,
+        before_commit: Optional[Callable[[int], None]] = None
         ) -> Response:
     record_to_delete = entity.query\
         .filter(entity.id == primary_key)\
@@ -141,6 +367,9 @@ def record_id_delete_response(
         response = Response('Record not found.', status=404)
         return response
     db.session.delete(record_to_delete)
+    db.session.flush()
+    if before_commit:
+        before_commit(primary_key)
     db.session.commit()
     response = Response('Record deleted.', status=200)
     return response
@@ -148,21 +377,149 @@ def record_id_delete_response(
 
 def entity_search_response(
         entity: db.Model,
-        schema: ma.SQLAlchemyAutoSchema
+        schema: ma.SQLAlchemyAutoSchema,
+        includes: Optional[Dict] = None
         ) -> Response:
+    if includes is None:
+        includes = {}
     parameters = request.args.to_dict()
-    filters = []
-    for label, column in get_features_except_id(entity).items():
-        if label in parameters:
-            value = parameters.get(label)
-            filters.append(column == value)
-            del parameters[label]
-    if not filters or parameters:
+    page_parameters = get_page_parameters(parameters)
+    field_parameters = get_field_parameters(parameters, schema, includes)
+    filters = get_search_filters(entity, parameters)
+    if not filters or not page_parameters or not field_parameters:
         response = Response('The URL parameter(s) are incorrect '
                             'or not specified.', status=400)
         return response
-    query = entity.query.filter(*filters).limit(1000).all()
-    entity_schema = schema(many=True)
-    response = jsonify(entity_schema.dump(query))
+    query = select_fields(entity, entity.query, schema, *field_parameters)
+    records, cursor = get_page(
+        entity, query.filter(*filters), *page_parameters)
+    return page_response(records, schema, cursor, *field_parameters)
+
+
+def stream_records(query: db.Query) -> Iterator[db.Model]:
+    # This reads rows from a server-side cursor in chunks
+    # rather than loading the entire result set into memory.
+    return query\
+        .execution_options(stream_results=True)\
+        .yield_per(EXPORT_CHUNK_SIZE)
+
+
+def generate_ndjson(
+        query: db.Query,
+        serialize: Callable
+        ) -> Iterator[bytes]:
+    prefixes = get_prefixes(serialize)
+    for record in stream_records(query):
+        yield dumps(serialize(record, prefixes)) + b'\n'
+
+
+def generate_csv(
+        query: db.Query,
+        serialize: Callable
+        ) -> Iterator[str]:
+    prefixes = get_prefixes(serialize)
+    buffer = StringIO()
+    # The columns follow the declared order of the schema.
+    writer = csv.DictWriter(buffer, fieldnames=serialize.keys)
+    writer.writeheader()
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for record in stream_records(query):
+        writer.writerow(serialize(record, prefixes))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def entity_export_response(
+        entity: db.Model,
+        schema: ma.SQLAlchemyAutoSchema,
+        includes: Optional[Dict] = None
+        ) -> Response:
+    if includes is None:
+        includes = {}
+    export_format = request.args.get('format', 'ndjson')
+    field_parameters = get_field_parameters(
+        request.args.to_dict(), schema, includes)
+    if not field_parameters:
+        response = Response('The URL parameter(s) are incorrect '
+                            'or not specified.', status=400)
+        return response
+    query = select_fields(entity, entity.query, schema, *field_parameters)
+    serialize = get_serializer(schema, *field_parameters)
+    if export_format == 'ndjson':
+        rows = generate_ndjson(query, serialize)
+        mimetype = 'application/x-ndjson'
+    # Related records are nested, so they have no place in a CSV row.
+    elif export_format == 'csv' and not field_parameters[1]:
+        rows = generate_csv(query, serialize)
+        mimetype = 'text/csv'
+    else:
+        response = Response('The URL parameter(s) are incorrect '
+                            'or not specified.', status=400)
+        return response
+    response = Response(stream_with_context(rows), mimetype=mimetype)
     response.status_code = 200
     return response
+
+
+def generate_blob_chunks(
+        entity: db.Model, column: db.Column,
+        primary_key: int, start: int, stop: int
+        ) -> Iterator[bytes]:
+    # Each chunk is read with its own substring query,
+    # so at most one chunk of the file is held in memory.
+    while start < stop:
+        length = min(BLOB_CHUNK_SIZE, stop - start)
+        yield db.session.query(func.substr(column, start + 1, length))\
+            .filter(entity.id == primary_key)\
+            .scalar()
+        start += length
+
+
+def record_id_blob_response(
+        primary_key: int,
+        entity: db.Model,
+        column_name: str,
+        mimetype: str
+        ) -> Response:
+    column = getattr(entity, column_name)
+    record = db.session.query(func.length(column), func.md5(column))\
+        .filter(entity.id == primary_key)\
+        .one_or_none()
+    if not record or record[0] is None:
+        response = Response('Record not found.', status=404)
+        return response
+    length, etag = record
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    start, stop = 0, length
+    status = 200
+    # A range is only served when there is no If-Range or it names
+    # the current ETag; a date or another ETag gets the whole blob.
+    if request.range and ('If-Range' not in request.headers
+                          or request.if_range.etag == etag):
+        requested_range = request.range.range_for_length(length)
+        if requested_range:
+            start, stop = requested_range
+            status = 206
+        elif len(request.range.ranges) == 1:
+            response = Response('Requested range not satisfiable.',
+                                status=416)
+            response.headers['Content-Range'] = 'bytes */{}'.format(length)
+            return response
+    response = Response(
+        stream_with_context(generate_blob_chunks(
+            entity, column, primary_key, start, stop)),
+        mimetype=mimetype
+        )
+    response.status_code = status
+    response.accept_ranges = 'bytes'
+    response.content_length = stop - start
+    response.set_etag(etag)
+    if status == 206:
+        response.content_range.set(start, stop, length)
+    return response
@@ -0,0 +1,85 @@
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Set, Tuple
+
+from sqlalchemy import inspect, LargeBinary, Text
+
+from config import db
+
+# The indexes of a table are read again after this many seconds,
+# so that an index created meanwhile drops out of the report.
+INDEX_MAX_AGE = 300
+# MySQL can only index TEXT and BLOB columns by a prefix, and 191
+# characters of utf8mb4 fit in the smallest InnoDB key prefix.
+PREFIX_LENGTH = 191
+
+
+class SearchReport:
+    """
+    This class counts the columns and operators used by the searchby
+    endpoints and recommends an index for every searched column that
+    does not lead an index of its table in the database
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.searches = {}
+        self.tables = {}
+
+    def record(self, table_name: str, column_name: str,
+               operator: str) -> None:
+        with self.lock:
+            column = self.searches.setdefault(
+                (table_name, column_name), {'searches': 0, 'operators': {}})
+            column['searches'] += 1
+            column['operators'][operator] = \
+                column['operators'].get(operator, 0) + 1
+        return None
+
+    def get_columns(self, table_name: str) -> Tuple[Set[str], Set[str]]:
+        # This returns the indexed columns of the table, and those
+        # that can only be indexed by a prefix. Only the first column
+        # of an index can be used to seek on a predicate of that
+        # column alone.
+        with self.lock:
+            cached = self.tables.get(table_name)
+        if cached and monotonic() - cached[0] < INDEX_MAX_AGE:
+            return cached[1:]
+        inspector = inspect(db.engine)
+        indexed = set(
+            inspector.get_pk_constraint(table_name)
+            ['constrained_columns'][:1]
+            )
+        for index in inspector.get_indexes(table_name):
+            indexed.update(index['column_names'][:1])
+        prefixed = {column['name']
+                    for column in inspector.get_columns(table_name)
+                    if isinstance(column['type'], (Text, LargeBinary))}
+        with self.lock:
+            self.tables[table_name] = (monotonic(), indexed, prefixed)
+        return indexed, prefixed
+
+    def report(self) -> List[Dict]:
+        with self.lock:
+            searches = {key: {'searches': column['searches'],
+                              'operators': dict(column['operators'])}
+                        for key, column in self.searches.items()}
+        report = []
+        for (table_name, column_name), column in sorted(
+                searches.items(), key=lambda item: -item[1]['searches']):
+            indexed_columns, prefixed = self.get_columns(table_name)
+            indexed = column_name in indexed_columns
+            report.append({
+                'table': table_name,
+                'column': column_name,
+                **column,
+                'indexed': indexed,
+                'recommendation': None if indexed else
+                'CREATE INDEX ix_{0}_{1} ON {0} (`{2}`{3})'.format(
+                    table_name, column_name.replace(' ', '_').lower(),
+                    column_name, '({})'.format(PREFIX_LENGTH)
+                    if column_name in prefixed else '')
+                })
+        return report
+
+
+search_report = SearchReport()
@@ -0,0 +1,194 @@
+import json
+from collections import OrderedDict
+from operator import attrgetter
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from flask import Response, url_for
+from marshmallow import fields
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+PLACEHOLDER = '987654321'
+# These fields already hold the column value as it should be dumped.
+PLAIN_FIELDS = (fields.String, fields.Integer, fields.Float, fields.Boolean)
+# Every combination of fields and includes compiles its own serializer,
+# so only the most recently used ones are kept.
+MAX_SERIALIZERS = 256
+
+serializers = OrderedDict()
+serializers_lock = Lock()
+field_attributes = {}
+
+
+class RecordUri(fields.Function):
+    """
+    This field dumps the URL of the endpoint for the record, and
+    exposes the endpoint so that the serializer can build the URL
+    from a prefix computed once per response
+    """
+    def __init__(self, endpoint: str, attribute: str = 'id', **kwargs):
+        self.endpoint = endpoint
+        self.key_attribute = attribute
+        super().__init__(
+            lambda obj: url_for(endpoint,
+                                primary_key=getattr(obj, attribute),
+                                _external=True),
+            **kwargs
+            )
+
+
+def get_field_attributes(schema) -> Dict[str, str]:
+    # This maps each dumped key to the attribute that it is read
+    # from, which for a record URI is the attribute of the key.
+    if schema not in field_attributes:
+        attributes = {}
+        for name, field in schema().dump_fields.items():
+            if isinstance(field, RecordUri):
+                attributes[field.data_key or name] = field.key_attribute
+            else:
+                attributes[field.data_key or name] = field.attribute or name
+        field_attributes[schema] = attributes
+    return field_attributes[schema]
+
+
+def get_ordered_fields(schema_instance) -> List[Tuple[str, Any]]:
+    # The dump fields of a schema that is not ordered come out of a
+    # set, so they are put in a stable order: the fields without a
+    # column as declared, then the columns in the order of the table.
+    model = schema_instance.Meta.model
+    positions = {column: index for index, column
+                 in enumerate(model.__table__.columns)}
+    columns = {prop.key: positions.get(prop.columns[0], len(positions))
+               for prop in model.__mapper__.column_attrs}
+    declared = {name: index for index, name
+                in enumerate(schema_instance.declared_fields)}
+
+    def get_order(item: Tuple[str, Any]) -> Tuple[int, int]:
+        name, field = item
+        attribute = field.attribute or name
+        if attribute in columns:
+            return 1, columns[attribute]
+        return 0, declared.get(name, len(declared))
+
+    return sorted(schema_instance.dump_fields.items(), key=get_order)
+
+
+def compile_schema(
+        schema, field_names: Optional[Tuple[str, ...]] = None,
+        includes: Tuple[Tuple[str, Any], ...] = ()
+        ) -> Callable[[Any], Dict]:
+    # This walks the fields of the schema once and returns a
+    # function that builds the dump of a record from a single
+    # attrgetter call plus the formatted record URIs.
+    schema_instance = schema()
+    plain = []
+    uris = []
+    other = []
+    dumped_keys = []
+    for name, field in get_ordered_fields(schema_instance):
+        key = field.data_key or name
+        if field_names is not None and key not in field_names:
+            continue
+        dumped_keys.append(key)
+        if isinstance(field, RecordUri):
+            uris.append((key, field.endpoint, field.key_attribute))
+        elif type(field) in PLAIN_FIELDS:
+            plain.append((key, field.attribute or name))
+        else:
+            other.append((key, name, field))
+    keys = [key for key, _ in plain]
+    if not plain:
+        get_values = lambda obj: ()
+    elif len(plain) == 1:
+        getter = attrgetter(plain[0][1])
+        get_values = lambda obj: (getter(obj),)
+    else:
+        get_values = attrgetter(*[attribute for _, attribute in plain])
+    relationships = schema.Meta.model.__mapper__.relationships
+    related = [(name, get_serializer(related_schema),
+                relationships[name].uselist)
+               for name, related_schema in includes]
+
+    def serialize(obj: Any, prefixes: Dict[str, tuple]) -> Dict:
+        data = dict(zip(keys, get_values(obj)))
+        for key, endpoint, attribute in uris:
+            prefix, suffix = prefixes[endpoint]
+            data[key] = prefix + str(getattr(obj, attribute)) + suffix
+        for key, name, field in other:
+            data[key] = field.serialize(name, obj)
+        for name, serialize_related, uselist in related:
+            value = getattr(obj, name)
+            if uselist:
+                data[name] = [serialize_related(record, prefixes)
+                              for record in value]
+            elif value is not None:
+                data[name] = serialize_related(value, prefixes)
+            else:
+                data[name] = None
+        return data
+
+    endpoints = [endpoint for _, endpoint, _ in uris]
+    for _, serialize_related, _ in related:
+        endpoints.extend(serialize_related.endpoints)
+    serialize.endpoints = list(dict.fromkeys(endpoints))
+    serialize.keys = dumped_keys + [name for name, _ in includes]
+    return serialize
+
+
+def get_serializer(
+        schema, field_names: Optional[Tuple[str, ...]] = None,
+        includes: Optional[Dict[str, Any]] = None
+        ) -> Callable[[Any, Dict[str, tuple]], Dict]:
+    # The dumped keys follow the order of the schema, so the
+    # same selection in any order shares one serializer.
+    key = (schema,
+           tuple(sorted(field_names)) if field_names is not None else None,
+           tuple(sorted(includes.items())) if includes else ())
+    with serializers_lock:
+        serialize = serializers.get(key)
+        if serialize is not None:
+            serializers.move_to_end(key)
+            return serialize
+    serialize = compile_schema(*key)
+    with serializers_lock:
+        serializers[key] = serialize
+        while len(serializers) > MAX_SERIALIZERS:
+            serializers.popitem(last=False)
+    return serialize
+
+
+def get_prefixes(serialize: Callable) -> Dict[str, tuple]:
+    prefixes = {}
+    for endpoint in serialize.endpoints:
+        url = url_for(endpoint, primary_key=PLACEHOLDER, _external=True)
+        prefixes[endpoint] = tuple(url.split(PLACEHOLDER, 1))
+    return prefixes
+
+
+def dump(schema, record: Any,
+         field_names: Optional[Tuple[str, ...]] = None,
+         includes: Optional[Dict[str, Any]] = None) -> Dict:
+    serialize = get_serializer(schema, field_names, includes)
+    return serialize(record, get_prefixes(serialize))
+
+
+def dump_many(schema, records: Iterable[Any],
+              field_names: Optional[Tuple[str, ...]] = None,
+              includes: Optional[Dict[str, Any]] = None) -> List[Dict]:
+    serialize = get_serializer(schema, field_names, includes)
+    prefixes = get_prefixes(serialize)
+    return [serialize(record, prefixes) for record in records]
+
+
+def dumps(data: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def json_response(data: Any, status: int = 200) -> Response:
+    return Response(dumps(data), status=status, mimetype='application/json')
@@ -0,0 +1,85 @@
+import json
+import logging
+from contextlib import contextmanager
+from hashlib import sha256
+from os import path, replace
+from typing import Any, Dict, Iterator, Tuple
+
+import yaml
+from connexion.spec import Specification
+
+logger = logging.getLogger(__name__)
+
+# The C loader parses the specification about ten times faster.
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def get_file_hash(file_path: str) -> str:
+    with open(file_path, 'rb') as file:
+        return sha256(file.read()).hexdigest()
+
+
+def load_spec(spec_path: str, cache_path: str) -> Tuple[Dict, bool]:
+    # This returns the specification and whether it was read from a
+    # cache written after connexion had validated the same file.
+    file_hash = get_file_hash(spec_path)
+    if cache_path and path.exists(cache_path):
+        try:
+            with open(cache_path) as file:
+                cache = json.load(file)
+            if cache['sha256'] == file_hash:
+                return cache['spec'], True
+        except (ValueError, KeyError) as e:
+            logger.warning('Ignoring unreadable spec cache: %s', e)
+    with open(spec_path, 'rb') as file:
+        spec = yaml.load(file, Loader=Loader)
+    # This matches the JSON round trip of the cache, in which
+    # the integer status codes of the responses become strings.
+    return json.loads(json.dumps(spec)), False
+
+
+def save_spec(spec: Dict, spec_path: str, cache_path: str) -> None:
+    if not cache_path:
+        return None
+    temp_path = cache_path + '.tmp'
+    try:
+        with open(temp_path, 'w') as file:
+            json.dump({'sha256': get_file_hash(spec_path), 'spec': spec},
+                      file)
+        # The rename is atomic, so a concurrent reader never
+        # sees a partially written cache.
+        replace(temp_path, cache_path)
+    except OSError as e:
+        logger.warning('Could not write spec cache: %s', e)
+    return None
+
+
+@contextmanager
+def skip_validation(skip: bool) -> Iterator[None]:
+    if not skip:
+        yield
+        return
+    # The cache is only written once the same file has passed
+    # validation, so validating it again would only cost time.
+    validators = {
+        cls: cls.__dict__['_validate_spec']
+        for cls in Specification.__subclasses__()
+        }
+    for cls in validators:
+        cls._validate_spec = classmethod(lambda cls, spec: None)
+    try:
+        yield
+    finally:
+        for cls, validator in validators.items():
+            cls._validate_spec = validator
+
+
+def add_cached_api(connexion_app, file_name: str,
+                   cache_path: str) -> Tuple[Any, bool]:
+    spec_path = path.join(connexion_app.specification_dir, file_name)
+    spec, cached = load_spec(spec_path, cache_path)
+    with skip_validation(cached):
+        api = connexion_app.add_api(spec)
+    if not cached:
+        save_spec(spec, spec_path, cache_path)
+    return api, cached
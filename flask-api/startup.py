@@ -0,0 +1,70 @@
+import logging
+from contextlib import contextmanager
+from os import getpid
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterator
+
+logger = logging.getLogger(__name__)
+
+
+class StartupReport:
+    """
+    This class records how long each phase of starting the
+    application took, in the master and in every forked worker
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.started_at = perf_counter()
+        self.phases = {}
+        self.details = {}
+        self.pid = getpid()
+        self.ready_at = None
+
+    def mark(self, phase: str) -> None:
+        # This records the time elapsed since the process started.
+        with self.lock:
+            self.phases[phase] = perf_counter() - self.started_at
+        return None
+
+    @contextmanager
+    def timed(self, phase: str) -> Iterator[None]:
+        started_at = perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[phase] = perf_counter() - started_at
+
+    def set_detail(self, name: str, value) -> None:
+        with self.lock:
+            self.details[name] = value
+        return None
+
+    def forked(self) -> None:
+        # The worker keeps the phases of the master
+        # and times its own start from the fork.
+        with self.lock:
+            self.details['master_pid'] = self.pid
+            self.pid = getpid()
+            self.started_at = perf_counter()
+        return None
+
+    def ready(self) -> None:
+        with self.lock:
+            self.ready_at = perf_counter() - self.started_at
+        logger.info('Process %s ready after %.3f seconds: %s',
+                    self.pid, self.ready_at, self.phases)
+        return None
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'pid': self.pid,
+                'ready_seconds': self.ready_at,
+                'phases_seconds': dict(self.phases),
+                **self.details
+                }
+
+
+startup_report = StartupReport()
@@ -0,0 +1,385 @@
+import json
+from os import makedirs, path, replace
+from threading import local, Lock
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from flask import jsonify, request, Response, url_for
+
+import model
+from config import app, connect_db, db
+
+PATH = ''
+CHUNK_SIZE = 10000
+MATCH_CHUNK_SIZE = 500
+MAX_LIMIT = 1000
+ARRAYS = ('compound_ids', 'sim', 'sim_counts', 'sub')
+# This counts the set bits of every possible byte.
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)],
+                    dtype=np.uint8)
+
+indigo_threads = local()
+
+
+def get_indigo():
+    # An Indigo instance must not be shared between threads.
+    if not hasattr(indigo_threads, 'indigo'):
+        from indigo import Indigo
+        indigo_threads.indigo = Indigo()
+    return indigo_threads.indigo
+
+
+def get_sim_region() -> slice:
+    # The similarity bits of an Indigo fingerprint follow the
+    # extra and ordinary parts of the full fingerprint buffer.
+    indigo = get_indigo()
+    start = 8 * int(indigo.getOption('fp-ord-qwords'))
+    if indigo.getOption('fp-ext-enabled') == 'true':
+        start += 3
+    length = 8 * int(indigo.getOption('fp-sim-qwords'))
+    return slice(start, start + length)
+
+
+def get_fingerprint(molecule, kind: str) -> np.ndarray:
+    return np.frombuffer(
+        molecule.fingerprint(kind).toBuffer().tobytes(), dtype=np.uint8)
+
+
+def popcount(matrix: np.ndarray) -> np.ndarray:
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(matrix).sum(axis=-1, dtype=np.uint32)
+    return POPCOUNT[matrix].sum(axis=-1, dtype=np.uint32)
+
+
+class FingerprintIndex:
+    """
+    This class holds the Indigo fingerprints of every compound as
+    packed bit matrices, which are saved as NumPy files and memory
+    mapped from disk, for similarity and substructure searches. The
+    matrices are built offline, and the compounds added since are
+    fingerprinted into smaller matrices held in memory, which are
+    dropped when the files are reloaded after the max age
+    """
+    def __init__(self, directory: str, max_age: float,
+                 check_interval: float):
+        self.directory = directory
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.lock = Lock()
+        self.build_lock = Lock()
+        self.arrays = None
+        self.added = None
+        self.last_id = 0
+        self.loaded_at = None
+        self.checked_at = None
+        self.load_seconds = None
+        self.skipped = 0
+
+    @staticmethod
+    def fingerprint(
+            after_id: int) -> Tuple[Dict[str, np.ndarray], int, int]:
+        # This returns the arrays of the compounds above the given id,
+        # the number left out and the highest id read.
+        from indigo import IndigoException
+        indigo = get_indigo()
+        sim_region = get_sim_region()
+        sub_bytes = len(get_fingerprint(indigo.loadMolecule('C'), 'sub'))
+        compound_ids, sims, subs = [], [], []
+        skipped = 0
+        last_id = after_id
+        rows = db.session.query(model.Compounds.id, model.Compounds.smiles)\
+            .filter(model.Compounds.smiles.isnot(None))\
+            .filter(model.Compounds.id > after_id)\
+            .order_by(model.Compounds.id)\
+            .execution_options(stream_results=True)\
+            .yield_per(CHUNK_SIZE)
+        for compound_id, smiles in rows:
+            last_id = compound_id
+            try:
+                molecule = indigo.loadMolecule(smiles)
+                sim = get_fingerprint(molecule, 'sim')[sim_region]
+                sub = get_fingerprint(molecule, 'sub')
+            except IndigoException:
+                # An unparsable structure is left out of the index.
+                skipped += 1
+                continue
+            compound_ids.append(compound_id)
+            sims.append(sim)
+            subs.append(sub)
+        sim_bytes = sim_region.stop - sim_region.start
+        sim = np.array(sims, dtype=np.uint8).reshape(-1, sim_bytes)
+        arrays = {
+            'compound_ids': np.array(compound_ids, dtype=np.int64),
+            'sim': sim,
+            'sim_counts': popcount(sim),
+            'sub': np.array(subs, dtype=np.uint8).reshape(-1, sub_bytes)
+            }
+        return arrays, skipped, last_id
+
+    def build(self) -> None:
+        started_at = monotonic()
+        arrays, skipped, last_id = self.fingerprint(0)
+        if self.directory:
+            self.save(arrays)
+            arrays = self.read()
+        self.set_arrays(arrays, last_id, skipped, started_at)
+        return None
+
+    def set_arrays(self, arrays: Dict[str, np.ndarray], last_id: int,
+                   skipped: int, started_at: float) -> None:
+        with self.lock:
+            self.arrays = arrays
+            self.added = None
+            self.last_id = last_id
+            self.skipped = skipped
+            self.loaded_at = self.checked_at = started_at
+            self.load_seconds = monotonic() - started_at
+        return None
+
+    def save(self, arrays: Dict[str, np.ndarray]) -> None:
+        makedirs(self.directory, exist_ok=True)
+        for name, array in arrays.items():
+            file_path = path.join(self.directory, name + '.npy')
+            np.save(file_path + '.tmp.npy', array)
+            replace(file_path + '.tmp.npy', file_path)
+        return None
+
+    def read(self) -> Optional[Dict[str, np.ndarray]]:
+        if not all(path.exists(path.join(self.directory, name + '.npy'))
+                   for name in ARRAYS):
+            return None
+        # The matrices are paged in by the operating system, and
+        # the pages are shared by every worker on the same host.
+        return {name: np.load(path.join(self.directory, name + '.npy'),
+                              mmap_mode='r')
+                for name in ARRAYS}
+
+    def load(self) -> None:
+        # Building the whole index takes too long for a request, so
+        # until the files exist the searches are unavailable, and
+        # an index already loaded is kept if they disappear.
+        started_at = monotonic()
+        arrays = self.read() if self.directory else None
+        if arrays is None:
+            return None
+        compound_ids = arrays['compound_ids']
+        self.set_arrays(arrays, int(compound_ids[-1])
+                        if len(compound_ids) else 0, 0, started_at)
+        # The compounds added since the files were saved are indexed now.
+        self.update()
+        return None
+
+    def update(self) -> None:
+        started_at = monotonic()
+        with self.lock:
+            added, last_id = self.added, self.last_id
+        arrays, skipped, new_last_id = self.fingerprint(last_id)
+        if added is not None:
+            arrays = {name: np.concatenate((added[name], arrays[name]))
+                      for name in ARRAYS}
+        with self.lock:
+            if new_last_id != last_id:
+                self.added = arrays
+                self.last_id = new_last_id
+                self.skipped += skipped
+            self.checked_at = started_at
+        return None
+
+    def get_parts(self) -> Optional[List[Dict[str, np.ndarray]]]:
+        # This returns None while the index has not been built.
+        now = monotonic()
+        with self.lock:
+            loaded = self.arrays is not None
+            due = not loaded or now - self.checked_at >= self.check_interval
+        # One request reloads or updates the index while the others
+        # search the current arrays, and only wait for the first load.
+        if due and self.build_lock.acquire(blocking=not loaded):
+            try:
+                if self.arrays is None \
+                        or now - self.loaded_at >= self.max_age:
+                    self.load()
+                elif now - self.checked_at >= self.check_interval:
+                    self.update()
+            finally:
+                self.build_lock.release()
+        with self.lock:
+            if self.arrays is None:
+                return None
+            return [arrays for arrays in (self.arrays, self.added)
+                    if arrays is not None]
+
+    def similar(self, smiles: str, limit: int,
+                threshold: float) -> Optional[List[Tuple[int, float]]]:
+        parts = self.get_parts()
+        if parts is None:
+            return None
+        molecule = get_indigo().loadMolecule(smiles)
+        query = get_fingerprint(molecule, 'sim')[get_sim_region()]
+        query_count = int(popcount(query))
+        results = []
+        for arrays in parts:
+            common = popcount(arrays['sim'] & query)
+            union = arrays['sim_counts'] + query_count - common
+            similarity = np.divide(common, union,
+                                   out=np.zeros(len(common)),
+                                   where=union > 0)
+            count = min(limit, len(similarity))
+            if not count:
+                continue
+            top = np.argpartition(-similarity, count - 1)[:count]
+            top = top[np.argsort(-similarity[top], kind='stable')]
+            results.extend(
+                (int(arrays['compound_ids'][row]), float(similarity[row]))
+                for row in top if similarity[row] >= threshold)
+        return sorted(results, key=lambda result: -result[1])[:limit]
+
+    def get_candidates(self, query: np.ndarray) -> Optional[np.ndarray]:
+        # A compound can only contain the query if its fingerprint has
+        # every bit of the query, so only those bytes are compared.
+        parts = self.get_parts()
+        if parts is None:
+            return None
+        columns = np.flatnonzero(query)
+        candidates = []
+        for arrays in parts:
+            matrix = arrays['sub'][:, columns]
+            screened = ((matrix & query[columns])
+                        == query[columns]).all(axis=1)
+            candidates.append(arrays['compound_ids'][screened])
+        return np.concatenate(candidates)
+
+    def substructure(self, smiles: str,
+                     limit: int) -> Optional[Tuple[List[int], int]]:
+        from indigo import IndigoException
+        indigo = get_indigo()
+        query = indigo.loadQueryMolecule(smiles)
+        candidates = self.get_candidates(get_fingerprint(query, 'sub'))
+        if candidates is None:
+            return None
+        matches = []
+        for start in range(0, len(candidates), MATCH_CHUNK_SIZE):
+            chunk = [int(compound_id) for compound_id
+                     in candidates[start:start + MATCH_CHUNK_SIZE]]
+            rows = db.session.query(
+                    model.Compounds.id, model.Compounds.smiles)\
+                .filter(model.Compounds.id.in_(chunk))\
+                .order_by(model.Compounds.id)
+            for compound_id, compound_smiles in rows:
+                try:
+                    target = indigo.loadMolecule(compound_smiles)
+                except IndigoException:
+                    continue
+                if indigo.substructureMatcher(target).match(query) \
+                        is not None:
+                    matches.append(compound_id)
+                    if len(matches) == limit:
+                        return matches, len(candidates)
+        return matches, len(candidates)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            arrays = self.arrays
+            parts = [part for part in (arrays, self.added)
+                     if part is not None]
+            return {
+                'available': arrays is not None,
+                'compounds': sum(len(part['compound_ids'])
+                                 for part in parts),
+                'added_compounds': len(self.added['compound_ids'])
+                if self.added is not None else 0,
+                'last_id': self.last_id,
+                'bytes': sum(array.nbytes for part in parts
+                             for array in part.values()),
+                'memory_mapped': arrays is not None
+                and isinstance(arrays['sim'], np.memmap),
+                'skipped': self.skipped,
+                'load_seconds': self.load_seconds
+                }
+
+
+fingerprint_index = FingerprintIndex(
+    app.config['FINGERPRINT_INDEX_PATH'],
+    app.config['FINGERPRINT_INDEX_MAX_AGE'],
+    app.config['FINGERPRINT_INDEX_CHECK_INTERVAL']
+    )
+
+
+def get_search_parameters(
+        default_limit: int
+        ) -> Optional[Tuple[str, int, float]]:
+    smiles = request.args.get('smiles', '')
+    try:
+        limit = int(request.args.get('limit', default_limit))
+        threshold = float(request.args.get('threshold', 0.0))
+    except ValueError:
+        return None
+    if not smiles or limit < 1 or limit > MAX_LIMIT \
+            or not 0.0 <= threshold <= 1.0:
+        return None
+    return smiles, limit, threshold
+
+
+def compound_uri(compound_id: int) -> str:
+    return url_for('/api.operations_compounds_get_record',
+                   primary_key=compound_id, _external=True)
+
+
+def unavailable_response() -> Response:
+    response = Response('The fingerprint index has not been built. '
+                        'Run python structure_search.py to build it.',
+                        status=503)
+    return response
+
+
+def similar() -> Response:
+    parameters = get_search_parameters(10)
+    if not parameters:
+        response = Response('The URL parameter(s) are incorrect '
+                            'or not specified.', status=400)
+        return response
+    from indigo import IndigoException
+    try:
+        results = fingerprint_index.similar(*parameters)
+    except IndigoException:
+        response = Response('The SMILES could not be parsed.', status=400)
+        return response
+    if results is None:
+        return unavailable_response()
+    return jsonify([{'id': compound_id,
+                     'similarity': round(similarity, 4),
+                     'uri': compound_uri(compound_id)}
+                    for compound_id, similarity in results])
+
+
+def substructure() -> Response:
+    parameters = get_search_parameters(100)
+    if not parameters:
+        response = Response('The URL parameter(s) are incorrect '
+                            'or not specified.', status=400)
+        return response
+    smiles, limit, _ = parameters
+    from indigo import IndigoException
+    try:
+        results = fingerprint_index.substructure(smiles, limit)
+    except IndigoException:
+        response = Response('The SMILES could not be parsed.', status=400)
+        return response
+    if results is None:
+        return unavailable_response()
+    matches, candidates = results
+    response = jsonify([{'id': compound_id, 'uri': compound_uri(compound_id)}
+                        for compound_id in matches])
+    response.headers['X-Screened-Candidates'] = str(candidates)
+    return response
+
+
+if __name__ == '__main__':
+    with open(path.join(PATH, 'config.json')) as file:
+        login_info = json.load(file)
+    if not fingerprint_index.directory:
+        raise SystemExit('Set FINGERPRINT_INDEX_PATH to the directory '
+                         'to build the fingerprint index in.')
+    connect_db(app, db, login_info)
+    fingerprint_index.build()
+    print(fingerprint_index.stats())
@@ -0,0 +1,100 @@
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterable, Optional, Tuple
+
+import model
+from config import db
+
+CHUNK_SIZE = 10000
+
+
+def normalize(identifier: str) -> str:
+    # This matches identifiers as the default collation of MySQL
+    # did, ignoring case and trailing spaces.
+    return identifier.rstrip(' ').casefold()
+
+
+class SynonymIndex:
+    """
+    This class holds an in-memory hash index from each normalized
+    synonym_mv identifier to its best ranked generic substance id, which is
+    loaded on first use and reloaded once it is older than max_age,
+    by one request at a time while the others use the old index
+    """
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self.lock = Lock()
+        self.refresh_lock = Lock()
+        self.index = None
+        self.loaded_at = None
+        self.load_seconds = None
+
+    def refresh(self) -> None:
+        # A refresh asked for while another one runs is dropped, so
+        # that concurrent callers do not each scan the whole table.
+        if not self.refresh_lock.acquire(blocking=False):
+            return None
+        try:
+            self.load()
+        finally:
+            self.refresh_lock.release()
+        return None
+
+    def load(self) -> None:
+        started_at = monotonic()
+        rows = db.session.query(
+                model.SynonymMv.identifier,
+                model.SynonymMv.fk_generic_substance_id
+                )\
+            .order_by(model.SynonymMv.rank.desc())\
+            .execution_options(stream_results=True)\
+            .yield_per(CHUNK_SIZE)
+        index = self.build(rows)
+        with self.lock:
+            self.index = index
+            self.loaded_at = monotonic()
+            self.load_seconds = self.loaded_at - started_at
+        return None
+
+    @staticmethod
+    def build(rows: Iterable[Tuple[str, int]]) -> Dict[str, int]:
+        # The rows come in rank order, and later rows
+        # overwrite earlier rows, so the best rank wins.
+        index = {}
+        for identifier, generic_substance_id in rows:
+            if identifier is not None:
+                index[normalize(identifier)] = generic_substance_id
+        return index
+
+    def get_index(self) -> Dict[str, int]:
+        with self.lock:
+            index, loaded_at = self.index, self.loaded_at
+        if index is None:
+            # Only the first load is waited for.
+            with self.refresh_lock:
+                if self.index is None:
+                    self.load()
+            return self.index
+        if monotonic() - loaded_at > self.max_age:
+            self.refresh()
+        return index
+
+    def get(self, identifier: str) -> Optional[int]:
+        return self.get_index().get(normalize(identifier))
+
+    def get_many(self, identifiers: Iterable[str]) -> Dict[str, int]:
+        # The ids are keyed by the identifiers as they were given.
+        index = self.get_index()
+        return {identifier: index[normalize(identifier)]
+                for identifier in identifiers
+                if normalize(identifier) in index}
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'size': len(self.index) if self.index is not None else 0,
+                'age_seconds': monotonic() - self.loaded_at
+                if self.loaded_at is not None else None,
+                'load_seconds': self.load_seconds,
+                'max_age_seconds': self.max_age
+                }
@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# The modules of the API import each other as top-level modules.
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
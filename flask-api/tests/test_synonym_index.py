@@ -0,0 +1,36 @@
+from time import monotonic
+
+from synonym_index import normalize, SynonymIndex
+
+
+def get_synonym_index(rows) -> SynonymIndex:
+    synonym_index = SynonymIndex(max_age=3600)
+    synonym_index.index = SynonymIndex.build(rows)
+    synonym_index.loaded_at = monotonic()
+    return synonym_index
+
+
+def test_normalize_ignores_case_and_trailing_spaces():
+    assert normalize('Atrazine') == 'atrazine'
+    assert normalize('ATRAZINE  ') == 'atrazine'
+    assert normalize(' atrazine') == ' atrazine'
+
+
+def test_get_matches_like_the_collation():
+    synonym_index = get_synonym_index([('Atrazine', 1)])
+    assert synonym_index.get('Atrazine') == 1
+    assert synonym_index.get('atrazine') == 1
+    assert synonym_index.get('ATRAZINE  ') == 1
+    assert synonym_index.get('Simazine') is None
+
+
+def test_get_many_keeps_the_given_identifiers():
+    synonym_index = get_synonym_index([('Atrazine', 1), ('Simazine', 2)])
+    assert synonym_index.get_many(['atrazine', 'SIMAZINE ', 'Propazine'])\
+        == {'atrazine': 1, 'SIMAZINE ': 2}
+
+
+def test_best_rank_wins_across_case_variants():
+    # The rows come ordered by rank, best last.
+    synonym_index = get_synonym_index([('ATRAZINE', 2), ('Atrazine', 1)])
+    assert synonym_index.get('atrazine') == 1
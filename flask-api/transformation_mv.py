@@ -0,0 +1,277 @@
+import json
+from os import path
+from typing import Iterable, Set
+
+from sqlalchemy import bindparam, or_, text
+
+import model
+from config import app, connect_db, db
+
+PATH = ''
+
+# The author names are aggregated with the functions of each dialect.
+AUTHORS = {
+    'mysql': """GROUP_CONCAT(
+            CASE
+                WHEN CONCAT_WS(' ', A.first_name, A.middle_name, A.last_name) = ' '
+                THEN NULL
+                ELSE CONCAT_WS(' ', A.first_name, A.middle_name, A.last_name)
+            END
+            ORDER BY A.last_name
+            SEPARATOR ', '
+            )""",
+    # SQLite only orders the aggregate from version 3.44.
+    'sqlite': """GROUP_CONCAT(
+            NULLIF(
+                TRIM(
+                    COALESCE(A.first_name || ' ', '')
+                    || COALESCE(A.middle_name || ' ', '')
+                    || COALESCE(A.last_name, '')
+                    ),
+                ''
+                ),
+            ', '
+            )"""
+    }
+TRANSFORMATION_SELECT = """
+    SELECT
+        SR.id,
+        C.id,
+        PRED.dsstox_substance_id,
+        PRED.preferred_name,
+        PRED.smiles,
+        PRED.casrn,
+        PRED.substance_type,
+        PRED.label,
+        SUCC.dsstox_substance_id,
+        SUCC.preferred_name,
+        SUCC.smiles,
+        SUCC.casrn,
+        SUCC.substance_type,
+        SUCC.label,
+        SR.relationship,
+        K.pH,
+        K.pH_min,
+        K.pH_max,
+        K.half_life,
+        K.half_life_min,
+        K.half_life_max,
+        K.half_life_units,
+        K.rate,
+        K.rate_min,
+        K.rate_max,
+        K.rate_units,
+        K.activation_kcal_per_mol,
+        K.temp_C,
+        K.reaction,
+        K.comments,
+        {authors},
+        C.year,
+        C.month,
+        C.day,
+        C.publisher,
+        C.title,
+        C.journal,
+        C.volume,
+        C.issue,
+        C.pages,
+        C.doi,
+        C.url
+    FROM
+        substance_relationships SR
+        INNER JOIN substance_relationship_types SRT
+            ON SR.fk_substance_relationship_type_id = SRT.id
+        INNER JOIN ( -- predecessor substance
+            SELECT
+                GSP.id,
+                GSP.dsstox_substance_id,
+                GSP.preferred_name,
+                GSP.casrn,
+                CP.smiles,
+                GSP.substance_type,
+                QCP.label
+            FROM
+                generic_substances GSP
+                INNER JOIN qc_levels QCP
+                    ON GSP.fk_qc_level_id = QCP.id
+                LEFT JOIN generic_substance_compounds GSCP
+                    ON GSCP.fk_generic_substance_id = GSP.id
+                LEFT JOIN compounds CP
+                    ON GSCP.fk_compound_id = CP.id
+            )
+        AS PRED
+            ON SR.fk_generic_substance_id_predecessor = PRED.id
+        LEFT JOIN ( -- successor substance
+            SELECT
+                GSS.id,
+                GSS.dsstox_substance_id,
+                GSS.preferred_name,
+                GSS.casrn,
+                CS.smiles,
+                GSS.substance_type,
+                QCS.label
+            FROM
+                generic_substances GSS
+                INNER JOIN qc_levels QCS
+                    ON GSS.fk_qc_level_id = QCS.id
+                LEFT JOIN generic_substance_compounds GSCS
+                    ON GSCS.fk_generic_substance_id = GSS.id
+                LEFT JOIN compounds CS
+                    ON GSCS.fk_compound_id = CS.id
+            )
+        AS SUCC
+            ON SR.fk_generic_substance_id_successor = SUCC.id
+        LEFT JOIN kinetics K
+            ON K.fk_substance_relationship_id = SR.id
+        INNER JOIN transformation_cited TC
+            ON TC.fk_substance_relationship_id = SR.id
+        INNER JOIN citation C
+            ON TC.fk_citation_id = C.id
+        LEFT JOIN author_cited AC
+            ON AC.fk_citation_id = C.id
+        LEFT JOIN author A
+            ON AC.fk_author_id = A.id
+    WHERE
+        SRT.name = 'transformation_product'
+        {filter}
+    GROUP BY
+        SR.id,
+        C.id,
+        PRED.dsstox_substance_id,
+        PRED.preferred_name,
+        PRED.smiles,
+        PRED.casrn,
+        PRED.substance_type,
+        PRED.label,
+        SUCC.dsstox_substance_id,
+        SUCC.preferred_name,
+        SUCC.smiles,
+        SUCC.casrn,
+        SUCC.substance_type,
+        SUCC.label,
+        SR.relationship,
+        K.pH,
+        K.pH_min,
+        K.pH_max,
+        K.half_life,
+        K.half_life_min,
+        K.half_life_max,
+        K.half_life_units,
+        K.rate,
+        K.rate_min,
+        K.rate_max,
+        K.rate_units,
+        K.activation_kcal_per_mol,
+        K.temp_C,
+        K.reaction,
+        K.comments,
+        C.month,
+        C.day,
+        C.year,
+        C.publisher,
+        C.title,
+        C.journal,
+        C.volume,
+        C.issue,
+        C.pages,
+        C.doi,
+        C.url
+    """
+
+
+def get_transformation_mv_columns() -> list:
+    return [column.name
+            for column in model.TransformationMv.__table__.columns
+            if column.name != 'id']
+
+
+def get_transformation_select(filter_clause: str) -> str:
+    return TRANSFORMATION_SELECT.format(
+        authors=AUTHORS[db.engine.dialect.name], filter=filter_clause)
+
+
+def rebuild_transformation_mv() -> None:
+    table = model.TransformationMv.__table__
+    table.create(db.engine, checkfirst=True)
+    select = text(get_transformation_select('')).columns()
+    db.session.execute(table.delete())
+    db.session.execute(
+        table.insert().from_select(get_transformation_mv_columns(), select))
+    db.session.commit()
+    return None
+
+
+def refresh_transformation_mv(
+        substance_relationship_ids: Iterable[int]) -> None:
+    # This runs in the transaction of the write, after it has been
+    # flushed, and is committed along with it by the caller.
+    substance_relationship_ids = \
+        [i for i in set(substance_relationship_ids) if i is not None]
+    if not substance_relationship_ids:
+        return None
+    table = model.TransformationMv.__table__
+    select = text(get_transformation_select('AND SR.id IN :ids'))\
+        .bindparams(bindparam('ids', substance_relationship_ids,
+                              expanding=True))\
+        .columns()
+    db.session.execute(
+        table.delete().where(
+            table.c.fk_substance_relationship_id
+            .in_(substance_relationship_ids)
+            )
+        )
+    db.session.execute(
+        table.insert().from_select(get_transformation_mv_columns(), select))
+    return None
+
+
+def get_substance_relationship_ids(
+        entity: db.Model, primary_key: int) -> Set[int]:
+    # This finds the substance relationships whose
+    # rows in transformation_mv depend on the record.
+    relationships = model.SubstanceRelationships
+    if entity is relationships:
+        return {primary_key}
+    if entity is model.Kinetics:
+        query = db.session.query(model.Kinetics.fk_substance_relationship_id)\
+            .filter(model.Kinetics.id == primary_key)
+    elif entity is model.GenericSubstances:
+        query = db.session.query(relationships.id)\
+            .filter(or_(
+                relationships.fk_generic_substance_id_predecessor
+                == primary_key,
+                relationships.fk_generic_substance_id_successor
+                == primary_key
+                ))
+    elif entity is model.Compounds:
+        mapping = model.generic_substance_compounds.c
+        query = db.session.query(relationships.id)\
+            .join(model.generic_substance_compounds, or_(
+                relationships.fk_generic_substance_id_predecessor
+                == mapping.fk_generic_substance_id,
+                relationships.fk_generic_substance_id_successor
+                == mapping.fk_generic_substance_id
+                ))\
+            .filter(mapping.fk_compound_id == primary_key)
+    elif entity is model.Citation:
+        mapping = model.transformation_cited.c
+        query = db.session.query(mapping.fk_substance_relationship_id)\
+            .filter(mapping.fk_citation_id == primary_key)
+    elif entity is model.Author:
+        mapping = model.transformation_cited.c
+        query = db.session.query(mapping.fk_substance_relationship_id)\
+            .join(model.author_cited,
+                  model.author_cited.c.fk_citation_id
+                  == mapping.fk_citation_id)\
+            .filter(model.author_cited.c.fk_author_id == primary_key)
+    else:
+        return set()
+    return {row[0] for row in query.all()}
+
+
+if __name__ == '__main__':
+    with open(path.join(PATH, 'config.json')) as file:
+        login_info = json.load(file)
+    with app.app_context():
+        connect_db(app, db, login_info)
+        rebuild_transformation_mv()